@@ -0,0 +1,58 @@
+import socket
+import threading
+import time
+
+from ringbuffer import SampleRingBuffer
+from waveform import WaveformFramer
+
+
+class AcquisitionThread(threading.Thread):
+    """Continuously drains the waveform socket into a SampleRingBuffer.
+
+    Runs independently of the Qt timer so slow repaints or game steps never leave data
+    sitting in the kernel buffer. Consumers read from `ring` through their own RingReader.
+    """
+
+    def __init__(self, swaveform, n_channels=2, ring=None, poll_interval=0.1, tracer=None):
+        super().__init__(name="acquisition", daemon=True)
+        self.swaveform = swaveform
+        self.framer = WaveformFramer(n_channels=n_channels)
+        self.ring = SampleRingBuffer(n_channels) if ring is None else ring
+        self.poll_interval = poll_interval
+        self._stop_event = threading.Event()
+        self.error = None
+        # Optional recorder.Recorder, every decoded block is queued to it
+        self.recorder = None
+        # Optional latency.LatencyTracer, times recv -> ring as the "decode" stage
+        self.tracer = tracer
+
+    def run(self):
+        # A timeout lets the loop notice stop() even when the server is not streaming
+        self.swaveform.settimeout(self.poll_interval)
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    n = self.framer.recv_into(self.swaveform)
+                except socket.timeout:
+                    continue
+                if n == 0:
+                    break
+                arrival = time.perf_counter()
+                timestamps, samples = self.framer.read()
+                if len(timestamps):
+                    self.ring.write(timestamps, samples, arrival)
+                    if self.tracer is not None:
+                        self.tracer.record_since("decode", arrival)
+                    recorder = self.recorder
+                    if recorder is not None:
+                        recorder.write_samples(timestamps, samples)
+        except OSError as e:
+            if not self._stop_event.is_set():
+                self.error = e
+
+    def reader(self):
+        return self.ring.reader()
+
+    def stop(self, timeout=1):
+        self._stop_event.set()
+        self.join(timeout)
@@ -0,0 +1,188 @@
+"""Throughput and per-tick latency of the decode -> feature -> control path.
+
+Feeds synthetic and recorded waveform byte streams through every stage at several
+channel counts and sample rates and reports samples/s and the cost of one
+TICK_INTERVAL worth of data. Run from the repository root:
+
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --save baseline.json
+    python benchmarks/bench_pipeline.py --compare baseline.json --tolerance 0.25
+
+--compare exits with status 1 if any case got slower than the baseline by more than
+the tolerance, so the script can gate changes.
+"""
+import argparse
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from features import window_features
+from plot_emg import SignalProcessor, integrate, moving_average
+from replay_server import pack_blocks
+from rhd import RhdRecording, read_rhd
+from session import import_session, load_session
+from waveform import FRAMES_PER_BLOCK, MAGIC_NUMBER, WaveformFramer, decode_blocks
+
+
+CHANNELS = (1, 2, 8, 32, 64)
+SAMPLE_RATES = (1000, 10000, 30000)
+TICK_INTERVAL = 0.1
+RHD_PATH = os.path.join(ROOT, "data/raw/leftarm_230301_153723/leftarm_230301_153823.rhd")
+SESSION_PATH = os.path.join(ROOT, "data/botharms_230301_160059")
+
+
+def synthetic_stream(n_channels, n_samples, seed=0):
+    raw = np.random.default_rng(seed).integers(32768 - 2000, 32768 + 2000, (n_channels, n_samples), dtype=np.uint16)
+    return pack_blocks(0, raw)
+
+
+def recorded_stream(n_channels, n_samples):
+    # Recorded channels repeated to fill n_channels and looped to fill n_samples
+    recording = RhdRecording(RHD_PATH)
+    _, raw = recording.read_raw()
+    raw = np.resize(raw, (raw.shape[0], n_samples))
+    return pack_blocks(0, np.resize(raw, (n_channels, n_samples)))
+
+
+def iter_unpack_decode(raw_data, n_channels):
+    """Per-sample struct loop formerly used in MainWindow.tick, generalized to n channels."""
+    data = []
+    fmt = "<i" + "H" * n_channels
+    for block_data in raw_data.split(struct.pack("<I", MAGIC_NUMBER))[1:]:
+        for raw_timestamp, *raw_samples in struct.iter_unpack(fmt, block_data):
+            data.append((raw_timestamp, *[(x - 32768) * 0.195 for x in raw_samples]))
+    return data
+
+
+def framer_decode(raw_data, n_channels, chunk):
+    framer = WaveformFramer(n_channels)
+    view = memoryview(raw_data)
+    for start in range(0, len(view), chunk):
+        framer.feed(view[start:start + chunk])
+
+
+def signal_processor_ticks(samples, tick):
+    sp = SignalProcessor(maxlen=50, ma_window=3)
+    for start in range(0, samples.shape[1], tick):
+        sp.update(samples[0, start:start + tick], samples[1, start:start + tick])
+
+
+def signal_processor_blocks(samples, tick, window):
+    sp = SignalProcessor(maxlen=50, ma_window=3, feature_window=window)
+    for start in range(0, samples.shape[1], tick):
+        sp.update_block(samples[:2, start:start + tick])
+
+
+def measure(fn, repeat, number=1):
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def run_cases(args):
+    results = []
+
+    def add(name, n_channels, sample_rate, n_samples, seconds):
+        per_tick = seconds * (sample_rate * TICK_INTERVAL) / n_samples
+        results.append({
+            "case": f"{name} ch={n_channels} fs={sample_rate}",
+            "samples_per_s": n_samples / seconds,
+            "tick_ms": per_tick * 1e3,
+            "tick_budget": per_tick / TICK_INTERVAL,
+        })
+        print(f"{results[-1]['case']:<45} {n_samples / seconds:14,.0f} samples/s"
+              f" {per_tick * 1e3:9.3f} ms/tick {100 * per_tick / TICK_INTERVAL:7.2f}% of tick", flush=True)
+        return tick
+
+    for sample_rate in args.sample_rates:
+        n_samples = int(sample_rate * args.seconds) // FRAMES_PER_BLOCK * FRAMES_PER_BLOCK
+        tick = int(sample_rate * TICK_INTERVAL)
+        for n_channels in args.channels:
+            for source in ("synthetic", "recorded"):
+                stream = (synthetic_stream if source == "synthetic" else recorded_stream)(n_channels, n_samples)
+                add(f"decode_blocks[{source}]", n_channels, sample_rate, n_samples,
+                    measure(lambda: decode_blocks(stream, n_channels), args.repeat))
+                # recv-sized chunks that split blocks, as a loaded socket would deliver them
+                add(f"framer[{source}]", n_channels, sample_rate, n_samples,
+                    measure(lambda: framer_decode(stream, n_channels, 4093), args.repeat))
+            if args.iter_unpack and n_samples * n_channels <= 2_000_000:
+                add("iter_unpack (old tick)", n_channels, sample_rate, n_samples,
+                    measure(lambda: iter_unpack_decode(stream, n_channels), 1))
+
+            _, samples = decode_blocks(stream, n_channels)
+            window = max(tick // 5, 3)
+            add("window_features", n_channels, sample_rate, n_samples,
+                measure(lambda: window_features(samples, window, window), args.repeat))
+            add("integrate+moving_average", n_channels, sample_rate, n_samples,
+                measure(lambda: moving_average(integrate(samples, max(n_samples // tick, 1)), 20), args.repeat))
+            # SignalProcessor only ever looks at two channels
+            if n_channels == 2:
+                add("SignalProcessor.update", n_channels, sample_rate, n_samples,
+                    measure(lambda: signal_processor_ticks(samples, tick), args.repeat))
+                add("SignalProcessor.update_block", n_channels, sample_rate, n_samples,
+                    measure(lambda: signal_processor_blocks(samples, tick, window), args.repeat))
+
+    recording = RhdRecording(RHD_PATH)
+    n, fs, ch = recording.n_samples, int(recording.sample_rate), len(recording.channel_names)
+    add("read_rhd", ch, fs, n, measure(lambda: read_rhd(RHD_PATH, notch=False), args.repeat))
+    add("RhdRecording.read 1s", ch, fs, fs,
+        measure(lambda: RhdRecording(RHD_PATH).read(61, 62, notch=False), args.repeat))
+    with tempfile.TemporaryDirectory() as session_dir:
+        for name in os.listdir(SESSION_PATH):
+            if name.endswith(".csv"):
+                shutil.copy(os.path.join(SESSION_PATH, name), session_dir)
+        session = load_session(session_dir)
+        add("import_session (CSV)", len(session.channel_names), int(session.sample_rate),
+            session.amplifier_data.shape[1], measure(lambda: import_session(session_dir, force=True), 1))
+    session = load_session(SESSION_PATH)
+    n, ch = session.amplifier_data.shape[1], len(session.channel_names)
+    add("load_session (cached)", ch, int(session.sample_rate), n,
+        measure(lambda: np.asarray(load_session(SESSION_PATH).amplifier_data).sum(), args.repeat))
+    return results
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {r["case"]: r for r in json.load(f)}
+    regressions = []
+    for result in results:
+        before = baseline.get(result["case"])
+        if before is None:
+            continue
+        change = before["samples_per_s"] / result["samples_per_s"] - 1
+        if change > tolerance:
+            regressions.append((result["case"], change))
+    for case, change in regressions:
+        print(f"REGRESSION {case}: {100 * change:.1f}% slower than baseline")
+    return not regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, nargs="+", default=CHANNELS)
+    parser.add_argument("--sample-rates", type=int, nargs="+", default=SAMPLE_RATES)
+    parser.add_argument("--seconds", type=float, default=5, help="stream length per case")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--iter-unpack", action="store_true", help="also time the old per-sample decoder")
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON written by --save")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = run_cases(args)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Compare plot_emg.integrate / moving_average with the original per-bucket loop versions.
+
+Run from the repository root:
+
+    python benchmarks/bench_plot_emg.py --seconds 3600 --channels 2
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from plot_emg import integrate, moving_average
+
+
+def moving_average_loop(a, n=3):
+    ret = np.cumsum(a, dtype=float)
+    ret[n:] = ret[n:] - ret[:-n]
+    ma = ret[n - 1:] / n
+    pad = np.zeros(n-1) * np.nan
+    ma = np.concatenate([pad, ma])
+    return ma
+
+
+def integrate_loop(a, n_buckets=60):
+    a = np.power(a, 2)
+    n = a.shape[0]
+    buckets = []
+    for i in range(n_buckets):
+        left = int(i / n_buckets * n)
+        right = int((i + 1) / n_buckets * n)
+        buckets.append(np.sum(np.abs(a[left:right])))
+    return np.array(buckets)
+
+
+def best_of(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=600)
+    parser.add_argument("--sample-rate", type=float, default=10000)
+    parser.add_argument("--channels", type=int, default=2)
+    parser.add_argument("--buckets-per-second", type=float, default=10)
+    parser.add_argument("--ma-window", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    n_samples = int(args.seconds * args.sample_rate)
+    n_buckets = int(args.seconds * args.buckets_per_second)
+    data = np.random.default_rng(0).normal(0, 100, (args.channels, n_samples)).astype(np.float32)
+    print(f"{args.channels} channels x {n_samples} samples, {n_buckets} buckets")
+
+    loop = best_of(lambda: [integrate_loop(ch, n_buckets) for ch in data], args.repeat)
+    vectorized = best_of(lambda: integrate(data, n_buckets), args.repeat)
+    vectorized32 = best_of(lambda: integrate(data, n_buckets, dtype=np.float32), args.repeat)
+    assert np.allclose([integrate_loop(ch, n_buckets) for ch in data], integrate(data, n_buckets))
+    print(f"integrate       loop {loop*1e3:9.2f} ms   vectorized {vectorized*1e3:9.2f} ms"
+          f"   float32 {vectorized32*1e3:9.2f} ms   speedup {loop/vectorized:6.1f}x")
+
+    energies = integrate(data, n_buckets)
+    loop = best_of(lambda: [moving_average_loop(ch, args.ma_window) for ch in energies], args.repeat)
+    vectorized = best_of(lambda: moving_average(energies, args.ma_window), args.repeat)
+    assert np.allclose([moving_average_loop(ch, args.ma_window) for ch in energies],
+                       moving_average(energies, args.ma_window), equal_nan=True)
+    print(f"moving_average  loop {loop*1e3:9.2f} ms   vectorized {vectorized*1e3:9.2f} ms"
+          f"   speedup {loop/vectorized:6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
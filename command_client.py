@@ -0,0 +1,265 @@
+"""Pipelined client for the Intan RHX TCP command server.
+
+Commands are written as soon as they are issued and replies are read by a background
+thread, so callers never sleep between commands or block on recv. Every command returns
+a concurrent.futures.Future:
+
+    client = CommandClient(scommand)
+    with client.batch():                     # one write, ';' separated
+        client.set("notchfilterfreqhertz", 60)
+        client.set("dspenabled", "true")
+    rate = client.get("sampleratehertz")     # Future of the value string
+    print(rate.result(timeout=1))
+
+The server only answers get commands ("Return: Name Value") and failed commands
+("Error: ..."), without any delimiter between replies. Replies are framed on those
+prefixes. A get is matched to its reply by parameter name, and an error by the command
+text it quotes, falling back to the oldest command still waiting for one. set and
+execute futures resolve once a reply to a later command arrives, since the server
+handles commands in order; sync() forces such a reply.
+"""
+import itertools
+import re
+import select
+import socket
+import threading
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+
+COMMAND_BUFFER_SIZE = 1024
+REPLY_START = re.compile(r"(?:Return|Error): ")
+# How long a reply that looks cut off waits for the rest
+PARTIAL_REPLY_WAIT = 0.05
+
+
+class CommandError(Exception):
+    """The server answered a command with "Error: ..."."""
+
+
+class Command:
+    def __init__(self, seq, text, expects_reply):
+        self.seq = seq
+        self.text = text
+        self.words = text.lower().split()
+        self.expects_reply = expects_reply
+        self.future = Future()
+
+    @property
+    def parameter(self):
+        return self.words[1] if len(self.words) > 1 else None
+
+
+class CommandClient:
+    def __init__(self, sock, listeners=()):
+        self.sock = sock
+        # Called with (parameter, value) for every "Return:" reply, see RunModeTracker
+        self.listeners = list(listeners)
+        self._send_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        # Commands waiting for a reply, and commands waiting for any later reply
+        self._pending = deque()
+        self._unconfirmed = deque()
+        self._seq = itertools.count()
+        # Per thread, so commands other threads send meanwhile (e.g. RunModeTracker
+        # callbacks on the reader thread) are written right away, not into this batch
+        self._local = threading.local()
+        self._closed = threading.Event()
+        self.errors = []
+        self._reader = threading.Thread(target=self._read_replies, name="command-client", daemon=True)
+        self._reader.start()
+
+    def send(self, text, expects_reply=False):
+        with self._pending_lock:
+            command = Command(next(self._seq), text, expects_reply)
+            (self._pending if expects_reply else self._unconfirmed).append(command)
+        batch = getattr(self._local, "batch", None)
+        if batch is not None:
+            batch.append(text)
+        else:
+            self._write([text])
+        return command.future
+
+    def get(self, parameter):
+        """Future of the value string of parameter, e.g. "Stop" for runmode."""
+        return self.send(f"get {parameter}", expects_reply=True)
+
+    def set(self, parameter, value):
+        if isinstance(value, bool):
+            value = str(value).lower()
+        return self.send(f"set {parameter} {value}")
+
+    def execute(self, action, expects_reply=False):
+        return self.send(f"execute {action}", expects_reply)
+
+    def sync(self):
+        """Future that resolves once every command sent so far has been handled."""
+        return self.get("runmode")
+
+    @contextmanager
+    def batch(self):
+        """Collect the commands this thread issues in the block and send them in a single write."""
+        outer = getattr(self._local, "batch", None) is not None
+        if not outer:
+            self._local.batch = []
+        try:
+            yield self
+        finally:
+            if not outer:
+                commands, self._local.batch = self._local.batch, None
+                if commands:
+                    self._write(commands)
+
+    def close(self):
+        self._closed.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._reader.join(1)
+
+    def _write(self, commands):
+        # Terminated too, so back to back writes that TCP merges still parse as separate commands
+        with self._send_lock:
+            self.sock.sendall("".join(f"{command};" for command in commands).encode())
+
+    def _read_replies(self):
+        text = ""
+        while not self._closed.is_set():
+            try:
+                data = self.sock.recv(COMMAND_BUFFER_SIZE)
+            except OSError:
+                break
+            if not data:
+                break
+            text += data.decode(errors="replace")
+            starts = [m.start() for m in REPLY_START.finditer(text)]
+            if not starts:
+                continue
+            # A reply ends where the next one starts. The last one is complete unless the
+            # server is still writing: the read filled the buffer or more data is already
+            # queued. A reply that looks cut off (ending in the first letters of a next
+            # reply, or a "Return:" with only a name so far) gets a short wait for more
+            # data, then counts as complete.
+            if (len(data) == COMMAND_BUFFER_SIZE or self._more_pending()
+                    or (self._looks_partial(text[starts[-1]:]) and self._more_pending(PARTIAL_REPLY_WAIT))):
+                replies, text = self._split(text, starts), text[starts[-1]:]
+            else:
+                replies, text = self._split(text, starts + [len(text)]), ""
+            for reply in replies:
+                self._dispatch(reply)
+        self._fail_pending(ConnectionError("Command connection closed"))
+
+    @staticmethod
+    def _split(text, bounds):
+        return [text[a:b].strip() for a, b in zip(bounds, bounds[1:])]
+
+    @staticmethod
+    def _looks_partial(reply):
+        # Ends in the first letters of a next reply, or a "Return:" without a value yet
+        if any(reply.endswith(prefix[:n]) for prefix in ("Return: ", "Error: ") for n in range(1, len(prefix))):
+            return True
+        return reply.startswith("Return: ") and " " not in reply[len("Return: "):].strip()
+
+    def _more_pending(self, timeout=0):
+        # select rather than a non-blocking peek, other threads are writing to the socket
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    def _dispatch(self, reply):
+        if reply.startswith("Return: "):
+            name, _, value = reply[len("Return: "):].partition(" ")
+            command = self._take(lambda c: c.parameter == name.lower())
+            for listener in self.listeners:
+                listener(name.lower(), value)
+            if command is not None:
+                command.future.set_result(value)
+            return
+
+        message = reply.lower()
+        command = (self._take(lambda c: c.text.lower() in message, unconfirmed=True)
+                   or self._take(lambda c: c.parameter is not None and c.parameter in message, unconfirmed=True)
+                   or self._take(lambda c: True))
+        if command is None:
+            self.errors.append(reply)
+        else:
+            command.future.set_exception(CommandError(reply))
+
+    def _take(self, match, unconfirmed=False):
+        """Remove and return the oldest pending command matching, confirming earlier ones."""
+        with self._pending_lock:
+            queues = (self._pending, self._unconfirmed) if unconfirmed else (self._pending,)
+            command = min((c for queue in queues for c in queue if match(c)), key=lambda c: c.seq, default=None)
+            if command is None:
+                return None
+            (self._pending if command.expects_reply else self._unconfirmed).remove(command)
+            # Everything written before this command has been handled by now
+            confirmed = []
+            while self._unconfirmed and self._unconfirmed[0].seq < command.seq:
+                confirmed.append(self._unconfirmed.popleft())
+        for c in confirmed:
+            c.future.set_result(None)
+        return command
+
+    def _fail_pending(self, error):
+        with self._pending_lock:
+            commands = list(self._pending) + list(self._unconfirmed)
+            self._pending.clear()
+            self._unconfirmed.clear()
+        for command in commands:
+            command.future.set_exception(error)
+
+
+class RunModeTracker:
+    """Cached run mode of the board, so the GUI never has to ask the server for it.
+
+    The cache follows our own set runmode commands as soon as they are sent, and any
+    "Return: RunMode ..." reply, whoever asked for it. While a set is in flight, replies
+    are ignored: they answer gets sent before it, since a reply to a later command
+    confirms the set first. A rejected set reverts the cache and asks the server for the
+    actual mode.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.mode = None
+        self._lock = threading.Lock()
+        self._sets_in_flight = 0
+        client.listeners.append(self._on_reply)
+
+    @property
+    def running(self):
+        return self.mode == "Run"
+
+    def refresh(self):
+        """Ask the server for the current mode; the reply updates the cache."""
+        return self.client.get("runmode")
+
+    def set(self, mode):
+        with self._lock:
+            previous, self.mode = self.mode, mode
+            self._sets_in_flight += 1
+        future = self.client.set("runmode", mode.lower())
+        future.add_done_callback(lambda f: self._on_set_done(f, previous))
+        return future
+
+    def ensure(self, mode):
+        """Set mode unless the cache says the board is already in it. Never blocks."""
+        if self.mode != mode:
+            return self.set(mode)
+        return None
+
+    def _on_set_done(self, future, previous):
+        with self._lock:
+            self._sets_in_flight -= 1
+            failed = future.exception() is not None
+            if failed:
+                self.mode = previous
+        if failed:
+            self.refresh()
+
+    def _on_reply(self, parameter, value):
+        with self._lock:
+            if parameter == "runmode" and not self._sets_in_flight:
+                self.mode = value
@@ -1,17 +1,20 @@
+import time
+# Taken before the GUI imports so the startup report includes them
+STARTED = time.perf_counter()
+
 from PySide6 import QtWidgets, QtCore
 from functools import partial
 
-from nes_py.wrappers import JoypadSpace
-import gym_super_mario_bros
-from gym_super_mario_bros.actions import RIGHT_ONLY
-import gym
-
 import pyqtgraph as pg
-import struct
-import time, socket
 import enum
 import numpy as np
-import itertools
+
+from acquisition import AcquisitionThread
+from command_client import CommandClient, RunModeTracker
+from engine import connect, configure_server, stop_server
+from game import GameProcess
+from latency import StartupTimer
+from ringbuffer import SampleRingBuffer
 
 
 COMMAND_BUFFER_SIZE = 1024
@@ -19,6 +22,8 @@ WAVEFORM_BUFFER_SIZE = 400000
 
 TICK_INTERVAL = 0.1
 CALIBRATION_ELAPSED = 5
+CALIBRATION_WINDOW = 1
+PLOT_WINDOW = 2
 SERVER_WAIT = 0.05
 
 class StateMachineModes(enum.Enum):
@@ -39,16 +44,19 @@ class PortListWidgetItem(QtWidgets.QListWidgetItem):
 
 
 class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self, scommand, swaveform, timestep):
+    def __init__(self, client, swaveform, timestep, game):
         super().__init__()
 
-        self.env = gym.make('SuperMarioBros-v0', apply_api_compatibility=True, render_mode="human")
-        self.env = JoypadSpace(self.env, RIGHT_ONLY)
-        self.env.reset()
+        self.game = game
 
-        self.scommand = scommand
+        self.client = client
+        self.run_mode = RunModeTracker(client)
+        self.run_mode.refresh()
         self.swaveform = swaveform
         self.timestep = timestep
+        self.acquisition = AcquisitionThread(swaveform, n_channels=2)
+        self.gui_reader = self.acquisition.reader()
+        self.acquisition.start()
 
         self._mode = StateMachineModes.IDLE
         self._tick_count = 0
@@ -114,6 +122,14 @@ class MainWindow(QtWidgets.QMainWindow):
         self.plot_zone_td1.setYRange(-1000, 1000, padding=0)
         self.vbox_plots.addWidget(self.plot_zone_td1)
 
+        # Curves are created once and updated in place with setData every tick. Peak
+        # downsampling keeps the cost at roughly one point pair per screen pixel.
+        self.curve_td0 = self.plot_zone_td0.plot(pen=pg.mkPen(color='r'))
+        self.curve_td1 = self.plot_zone_td1.plot(pen=pg.mkPen(color='b'))
+        for curve in (self.curve_td0, self.curve_td1):
+            curve.setDownsampling(auto=True, method='peak')
+            curve.setClipToView(True)
+
 
         self.hbox0.addLayout(self.vbox_plots)
 
@@ -138,7 +154,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.gameButton.setCheckable(True)
         self.gameButton.setEnabled(False)
         self.button_grp_vbox0.addWidget(self.gameButton)
-        #self.gameButton.clicked.connect(self.begin_game)
+        self.gameButton.toggled.connect(self.begin_game)
 
         self.info = QtWidgets.QLabel(f"Current State: {self._mode.value}")
         self.button_grp_vbox0.addWidget(self.info)
@@ -152,7 +168,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.vbox0.addWidget(self.cmd_display)
 
-        self.rolling_data = []
+        self.rolling_data = SampleRingBuffer.for_duration(PLOT_WINDOW, 1 / timestep, n_channels=2)
 
         self.timer = QtCore.QTimer()
         self.timer.timeout.connect(self.tick)
@@ -162,6 +178,11 @@ class MainWindow(QtWidgets.QMainWindow):
         self.calibration_timer.timeout.connect(self.calibration_tick)
         self.calibrationButton.clicked.connect(partial(self.calibration_timer.start, 1000)) # Do not change from 1 second since calibration_tick times for user)
 
+    def closeEvent(self, event):
+        self.acquisition.stop()
+        self.game.stop()
+        super().closeEvent(event)
+
     def write_to_cmd(self, msg: str):
         previous_text = '\n'.join(self.cmd_display.toPlainText().split('\n')[-50:])
         self.cmd_display.setText(f"{previous_text}\n{msg}")
@@ -175,20 +196,19 @@ class MainWindow(QtWidgets.QMainWindow):
             return
         self.selected_ports.addItem(PortListWidgetItem(double_clicked_port.text()))
         self.available_ports.takeItem(self.available_ports.row(double_clicked_port))
-        self.scommand.sendall(f"set {double_clicked_port.text().lower()}.tcpdataoutputenabled true".encode())
+        self.client.set(f"{double_clicked_port.text().lower()}.tcpdataoutputenabled", "true")
         self.write_to_cmd(f"Analog port: {double_clicked_port.text()} has been activated.")
         self.available_ports.sortItems()
         self.selected_ports.sortItems()
         if self.selected_ports.count() == 2:
             self.calibrationButton.setEnabled(True)
-            self.scommand.sendall(b'set runmode run')
-        time.sleep(SERVER_WAIT)
+            self.run_mode.set("Run")
 
 
     def remove_from_selected_ports(self, double_clicked_port):
         self.available_ports.addItem(PortListWidgetItem(double_clicked_port.text()))
         self.selected_ports.takeItem(self.selected_ports.row(double_clicked_port))
-        self.scommand.sendall(f"set {double_clicked_port.text().lower()}.tcpdataoutputenabled false".encode())
+        self.client.set(f"{double_clicked_port.text().lower()}.tcpdataoutputenabled", "false")
         self.write_to_cmd(f"Analog port: {double_clicked_port.text()} has been deactivated.")
         self.available_ports.sortItems()
         self.selected_ports.sortItems()
@@ -210,22 +230,15 @@ class MainWindow(QtWidgets.QMainWindow):
         #     asdf["time"], asdf["value"])
 
     def plot_time_domain_data(self):
-        # [([0, 1, 2, 3], [s1, s1, s1], [s2, s2, s2]), ([0, 1, 2, 3], [s1, s1, s1], [s2, s2, s2]), ....]
-        ts = [x[0] for x in self.rolling_data]  # [[0, 1, 2, 3], [0, 1, 2, 3], [0, 1, 2, 3]]
-        samp0 = [x[1] for x in self.rolling_data]  # [[s1, s1, s1], [s1, s1, s1], ...]
-        samp1 = [x[2] for x in self.rolling_data]
-        ts = list(itertools.chain(*ts))
-        samp0 = list(itertools.chain(*samp0))
-        samp1 = list(itertools.chain(*samp1))
+        timestamps, (samp0, samp1) = self.rolling_data.latest()
+        ts = timestamps * self.timestep
 
         # ts_all = list(ts[0])
         # for time_data in ts[1:]:
         #     ts_all.extend([x+ts_all[-1]+self.timestep for x in time_data])
 
-        self.plot_zone_td0.clear()
-        self.plot_zone_td1.clear()
-        self.plot_zone_td0.plot(ts, samp0, pen=pg.mkPen(color='r'))
-        self.plot_zone_td1.plot(ts, samp1, pen=pg.mkPen(color='b'))
+        self.curve_td0.setData(ts, samp0, skipFiniteCheck=True)
+        self.curve_td1.setData(ts, samp1, skipFiniteCheck=True)
 
     def plot_calibration_data(self):
         relax_data = list(zip(*self.calibration_data[StateMachineModes.CALIBRATE_P1_RELAX]))
@@ -286,19 +299,15 @@ class MainWindow(QtWidgets.QMainWindow):
     # Last second of data for calibration
     def calibrate(self):
         
-        samp0 = [x[1] for x in self.rolling_data[-10:]] 
-        samp1 = [x[2] for x in self.rolling_data[-10:]]
-        samp0 = list(itertools.chain(*samp0))
-        samp1 = list(itertools.chain(*samp1))
-        samp0 = [abs(x) for x in samp0]
-        samp1 = [abs(x) for x in samp1]
+        _, samples = self.rolling_data.latest_seconds(CALIBRATION_WINDOW)
+        samp0, samp1 = np.abs(samples)
         print(f"Samp 0 length:{len(samp0)}")
         print(f"Samp 1 length:{len(samp1)}")
         print(f"Rolling data length: {len(self.rolling_data)}")
         if self._mode == StateMachineModes.CALIBRATE_P1_RELAX:
-            self.calibration_data[StateMachineModes.CALIBRATE_P1_RELAX] = sum(samp0)/(2* len(samp0))
+            self.calibration_data[StateMachineModes.CALIBRATE_P1_RELAX] = samp0.sum()/(2* len(samp0))
         if self._mode == StateMachineModes.CALIBRATE_P1_FLEX:
-            self.calibration_data[StateMachineModes.CALIBRATE_P1_FLEX] = (sum(samp1) - sum(samp0))/(2*len(samp0))
+            self.calibration_data[StateMachineModes.CALIBRATE_P1_FLEX] = (samp1.sum() - samp0.sum())/(2*len(samp0))
         if self._mode == StateMachineModes.CALIBRATE_P2_RELAX:
             pass
         if self._mode == StateMachineModes.CALIBRATE_P2_FLEX:
@@ -308,43 +317,22 @@ class MainWindow(QtWidgets.QMainWindow):
         self.info.setText(f"Current State: {self._mode.value}")
 
         if self.selected_ports.count() != 2:
-            self.scommand.sendall(b'get runmode')
-            time.sleep(SERVER_WAIT)
-            if (str(self.scommand.recv(COMMAND_BUFFER_SIZE), "utf-8") != "Return: RunMode Stop"):
-                self.scommand.sendall(b'set runmode stop')
+            # Only sends a command if the board is (or might be) running
+            self.run_mode.ensure("Stop")
             self.gameButton.setEnabled(False)
             return
             # self.scommand.sendall(b'set runmode stop')
             # time.sleep(SERVER_WAIT)
-        data = []
-        raw_data = self.swaveform.recv(1028*16)
-        for block_data in raw_data.split(struct.pack("<I", 0x2ef07a08))[1:]:
-            # raw_sample[0] is the lowest selected channel
-            for raw_timestamp, raw_samples0, raw_samples1 in struct.iter_unpack(f"<iHH", block_data):
-                data.append(
-                    (
-                        raw_timestamp * self.timestep,
-                        (raw_samples0 - 32768)*0.195,
-                        (raw_samples1 - 32768)*0.195,
-                    ),
-                )
-        ts, samp0, samp1 = zip(*data)
-        self.rolling_data = self.rolling_data[-20:] + [(ts, samp0, samp1)]
+        # samples[0] is the lowest selected channel
+        timestamps, samples = self.gui_reader.read()
+        if len(timestamps) == 0:
+            return
+        self.rolling_data.write(timestamps, samples)
         self.plot_time_domain_data()
         # THIS 
-        if self.gameButton.isChecked() and any(x is not None for x in self.calibration_data.values()):
-            done = False
-
-            self.env.render()
-
-            action = self.env.action_space.sample()
-            for x in range(100):
-                obs, reward, terminated, truncated, info = self.env.step(action)
-            done = terminated or truncated
-            # Run out of lives set done
-            if done:
-                state = self.env.reset()
-            # self.env.close()
+        if self.gameButton.isChecked() and any(x is not None for x in self.calibration_data.values()) and self.game.ready:
+            # A new random action every tick, the game process plays it at its own frame rate
+            self.game.set_action(np.random.randint(self.game.n_actions))
 
 
 
@@ -353,86 +341,41 @@ class MainWindow(QtWidgets.QMainWindow):
         # if self._tick_count * TICK_INTERVAL == CALIBRATION_ELAPSED:
                 # self.plot_calibration_data()
                 
-    def begin_game(self):
-        pass
-
-
-def main():
-    print('Connecting to TCP command server...')
-    scommand = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    while True:
-        try:
-            scommand.connect(('127.0.0.1', 5000))
-        except ConnectionRefusedError:
-            print("Connection to TCP command server unsucessful.\n Trying again...")
-            time.sleep(1)
-        else:
-            break
-
-    print('Connecting to TCP waveform server...')
-    swaveform = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    while True:
-        try:
-            swaveform.connect(('127.0.0.1', 5001))
-        except ConnectionRefusedError:
-            print("Connection to TCP waveform server unsuccessful.\n Trying again...")
-            time.sleep(1)
+    def begin_game(self, checked):
+        if checked:
+            self.game.play()
         else:
-            break
-    
-    scommand.sendall(b'get runmode')
-    commandReturn = str(scommand.recv(COMMAND_BUFFER_SIZE), "utf-8")
-    isStopped = commandReturn == "Return: RunMode Stop"
-
-    if not isStopped:
-        scommand.sendall(b'set runmode stop')
-        time.sleep(SERVER_WAIT)
+            self.game.pause()
 
-    scommand.sendall(b'get sampleratehertz')
-    commandReturn = str(scommand.recv(COMMAND_BUFFER_SIZE), "utf-8")
-    expectedReturnString = "Return: SampleRateHertz "
-    if commandReturn.find(expectedReturnString) == -1: # Look for "Return: SampleRateHertz N" where N is the sample rate
-        raise Exception('Unable to get sample rate from server')
-    else:
-        sampleRate = float(commandReturn[len(expectedReturnString):])
 
-    timestep = 1 / sampleRate
+def print_startup_report(startup):
+    startup.mark("window shown")
+    print(startup.report())
 
-    scommand.sendall(b"set notchfilterfreqhertz 60")
-    time.sleep(SERVER_WAIT)
 
-    scommand.sendall(b"set dspenabled true")
-    time.sleep(SERVER_WAIT)
-
-    scommand.sendall(b"set desireddspcutofffreqhertz 20")
-    time.sleep(SERVER_WAIT)
-
-    scommand.sendall(b"set desiredlowerbandwidthhertz 2")
-    time.sleep(SERVER_WAIT)
-
-    scommand.sendall(b"set desiredupperbandwidthhertz 450")
-    time.sleep(SERVER_WAIT)
+def main():
+    startup = StartupTimer(STARTED)
+    startup.mark("imports")
+    # The game process loads the emulator while the server is configured and ports are selected
+    game = GameProcess(render_mode="human", env_id='SuperMarioBros-v0', movement="RIGHT_ONLY", started=STARTED)
+    game.start()
 
-    scommand.sendall(b"get actuallowerbandwidthhertz")
-    print(str(scommand.recv(COMMAND_BUFFER_SIZE), "utf-8"))
-    scommand.sendall(b"get actualupperbandwidthhertz")
-    print(str(scommand.recv(COMMAND_BUFFER_SIZE), "utf-8"))   
-    scommand.sendall(b'execute clearalldataoutputs')
-    time.sleep(SERVER_WAIT)
+    scommand, swaveform = connect()
+    client = CommandClient(scommand)
+    startup.mark("connected")
+    timestep = configure_server(client)
+    startup.mark("server configured")
 
 
     app = QtWidgets.QApplication([])
-    window = MainWindow(scommand, swaveform, timestep)
+    window = MainWindow(client, swaveform, timestep, game)
+    startup.mark("window created")
     window.show()
+    # Fires on the first pass of the event loop, i.e. once the window is actually up
+    QtCore.QTimer.singleShot(0, partial(print_startup_report, startup))
     app.exec()
 
-    scommand.sendall(b'get runmode')
-    commandReturn = str(scommand.recv(COMMAND_BUFFER_SIZE), "utf-8")
-    isStopped = commandReturn == "Return: RunMode Stop"
-
-    if not isStopped:
-        scommand.sendall(b'set runmode stop')
-        time.sleep(0.1)
+    stop_server(client)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,28 +1,26 @@
+import time
+# Taken before the GUI imports so the startup report includes them
+STARTED = time.perf_counter()
+
 from PySide6 import QtWidgets, QtCore
 from functools import partial
-from cProfile import run
-from nes_py.wrappers import JoypadSpace
-import gym_super_mario_bros
-from gym_super_mario_bros.actions import SIMPLE_MOVEMENT
-import gym
 
 import pyqtgraph as pg
-import struct
-import time, socket
 import enum
+import os
 import numpy as np
-import itertools
-import matplotlib.pyplot as plt
-
-from plot_emg import SignalProcessor
 
+from engine import (ControllerEngine, connect, configure_server, stop_server, ACTION_MAX_HOLD,
+                    TICK_INTERVAL, CONTROL_INTERVAL, CALIBRATION_ELAPSED, RECORDINGS_DIR)
+from command_client import CommandClient
+from game import GameProcess
+from latency import LatencyTracer, StartupTimer
+from ringbuffer import SampleRingBuffer
 
-COMMAND_BUFFER_SIZE = 1024
-WAVEFORM_BUFFER_SIZE = 400000
 
-TICK_INTERVAL = 0.1
-CALIBRATION_ELAPSED = 5
-SERVER_WAIT = 0.05
+PLOT_WINDOW = 2
+SIGNAL_PLOT_INTERVAL = 0.25
+LATENCY_REPORT_INTERVAL = 1
 
 
 class StateMachineModes(enum.Enum):
@@ -31,16 +29,8 @@ class StateMachineModes(enum.Enum):
     CALIBRATE_P1_FLEX = "Left Arm Flex"
     CALIBRATE_P2_RELAX = "Right Arm Relax"
     CALIBRATE_P2_FLEX = "Right Arm Flex"
-    
 
 
-ACTIONS = {
-    0: 0,  # relaxed -> no movement
-    1: 1,  # right arm -> move right
-    2: 6,  # left arm -> move left
-    3: 5,  # both arms -> move right and jump
-}
-
 
 class PortListWidgetItem(QtWidgets.QListWidgetItem):
     def __lt__(self, other):
@@ -50,20 +40,59 @@ class PortListWidgetItem(QtWidgets.QListWidgetItem):
             return QListWidgetItem.__lt__(self, other)
 
 
-class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self, scommand, swaveform, timestep):
+class SignalPlotWidget(pg.GraphicsLayoutWidget):
+    """Live view of SignalProcessor state: energies, difference, thresholds and controls."""
+
+    def __init__(self, sig_processor):
         super().__init__()
+        self.sig_processor = sig_processor
+
+        self.energy_plot = self.addPlot(row=0, col=0, title="Energy")
+        self.energy_plot.addLegend()
+        self.curve_ma_int1 = self.energy_plot.plot(pen=pg.mkPen(color='b'), name="Energy of Left Arm")
+        self.curve_ma_int2 = self.energy_plot.plot(pen=pg.mkPen(color='y'), name="Energy of Right Arm")
+        self.threshold1_line = pg.InfiniteLine(angle=0, pen=pg.mkPen(color='w', style=QtCore.Qt.DashLine))
+        self.energy_plot.addItem(self.threshold1_line)
+
+        self.diff_plot = self.addPlot(row=1, col=0, title="Stream 1 - Stream 2")
+        self.diff_plot.addLegend()
+        self.curve_diff = self.diff_plot.plot(pen=pg.mkPen(color='c'), name="Difference in Integrations")
+        self.curve_ma_diff = self.diff_plot.plot(pen=pg.mkPen(color='m'), name="Moving Average")
+        self.threshold_diff_line = pg.InfiniteLine(angle=0, pen=pg.mkPen(color='w', style=QtCore.Qt.DashLine))
+        self.diff_plot.addItem(self.threshold_diff_line)
+
+        self.control_plot = self.addPlot(row=2, col=0, title="Controls")
+        self.control_plot.setYRange(0, 3)
+        self.curve_controls = self.control_plot.plot(pen=pg.mkPen(color='g'), stepMode="right")
+
+    def refresh(self):
+        sp = self.sig_processor
+        if not sp.ticks:
+            return
+        ticks = np.asarray(sp.ticks)
+        self.curve_ma_int1.setData(ticks, np.asarray(sp.ma_int1))
+        self.curve_ma_int2.setData(ticks, np.asarray(sp.ma_int2))
+        self.threshold1_line.setValue(sp.threshold1)
+        self.curve_diff.setData(ticks, np.asarray(sp.diff))
+        self.curve_ma_diff.setData(ticks, np.asarray(sp.ma_diff))
+        self.threshold_diff_line.setValue(sp.threshold_diff)
+        self.curve_controls.setData(ticks, np.asarray(sp.controls))
 
-        self.env = gym.make('SuperMarioBros-v1', apply_api_compatibility=True, render_mode="human")
-        self.env = JoypadSpace(self.env, SIMPLE_MOVEMENT)
-        self.env.reset()
-        self.ma_window = 3
 
-        self.sig_processor = SignalProcessor(threshold1=50, threshold_diff=35,  ma_window=3, flip=False)
+class MainWindow(QtWidgets.QMainWindow):
+    """Qt front end for a ControllerEngine: port selection, calibration and live plots."""
 
-        self.scommand = scommand
-        self.swaveform = swaveform
-        self.timestep = timestep
+    def __init__(self, engine):
+        super().__init__()
+
+        self.engine = engine
+        self.ma_window = 3
+        self.sig_processor = engine.sig_processor
+        self.client = engine.client
+        self.timestep = engine.timestep
+        self.tracer = engine.tracer
+        self._last_latency_report = 0
+        self.gui_reader = engine.acquisition.reader()
 
         self._mode = StateMachineModes.IDLE
         self._tick_count = 0
@@ -129,6 +158,18 @@ class MainWindow(QtWidgets.QMainWindow):
         self.plot_zone_td1.setYRange(-1000, 1000, padding=0)
         self.vbox_plots.addWidget(self.plot_zone_td1)
 
+        # Curves are created once and updated in place with setData every tick. Peak
+        # downsampling keeps the cost at roughly one point pair per screen pixel.
+        self.curve_td0 = self.plot_zone_td0.plot(pen=pg.mkPen(color='r'))
+        self.curve_td1 = self.plot_zone_td1.plot(pen=pg.mkPen(color='b'))
+        for curve in (self.curve_td0, self.curve_td1):
+            curve.setDownsampling(auto=True, method='peak')
+            curve.setClipToView(True)
+
+        self.signal_plots = SignalPlotWidget(self.sig_processor)
+        self.signal_plots.setMinimumWidth(500)
+        self.vbox_plots.addWidget(self.signal_plots)
+
 
         self.hbox0.addLayout(self.vbox_plots)
 
@@ -153,10 +194,21 @@ class MainWindow(QtWidgets.QMainWindow):
         self.gameButton.setCheckable(True)
         self.gameButton.setEnabled(True)
         self.button_grp_vbox0.addWidget(self.gameButton)
-        #self.gameButton.clicked.connect(self.begin_game)
+        self.gameButton.toggled.connect(self.begin_game)
+
+        self.recordButton = QtWidgets.QPushButton("Record")
+        self.recordButton.setCheckable(True)
+        self.recordButton.toggled.connect(self.toggle_recording)
+        self.button_grp_vbox0.addWidget(self.recordButton)
+
+        self.saveLatencyButton = QtWidgets.QPushButton("Save Latency")
+        self.saveLatencyButton.clicked.connect(self.save_latency)
+        self.button_grp_vbox0.addWidget(self.saveLatencyButton)
 
         self.info = QtWidgets.QLabel(f"Current State: {self._mode.value}")
         self.button_grp_vbox0.addWidget(self.info)
+        self.latency_info = QtWidgets.QLabel("Latency p50 / p95 / p99")
+        self.button_grp_vbox0.addWidget(self.latency_info)
         self.button_grp_vbox0.addStretch()
 
         self.vbox0.addLayout(self.hbox0)
@@ -167,16 +219,46 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.vbox0.addWidget(self.cmd_display)
 
-        self.rolling_data = []
+        self.rolling_data = SampleRingBuffer.for_duration(PLOT_WINDOW, 1 / self.timestep, n_channels=2)
 
         self.timer = QtCore.QTimer()
         self.timer.timeout.connect(self.tick)
         self.timer.start(TICK_INTERVAL*1000)
 
+        self.control_timer = QtCore.QTimer()
+        self.control_timer.timeout.connect(self.engine.control_step)
+        self.control_timer.start(CONTROL_INTERVAL*1000)
+
+        # Redrawn on its own timer, at a lower rate than control_tick updates the processor
+        self.signal_plot_timer = QtCore.QTimer()
+        self.signal_plot_timer.timeout.connect(self.signal_plots.refresh)
+        self.signal_plot_timer.start(SIGNAL_PLOT_INTERVAL*1000)
+
         self.calibration_timer = QtCore.QTimer()
         self.calibration_timer.timeout.connect(self.calibration_tick)
         self.calibrationButton.clicked.connect(partial(self.calibration_timer.start, 1000)) # Do not change from 1 second since calibration_tick times for user)
 
+    def closeEvent(self, event):
+        self.engine.close()
+        super().closeEvent(event)
+
+    def toggle_recording(self, checked):
+        if checked:
+            path = self.engine.start_recording()
+            self.write_to_cmd(f"Recording to {path}.")
+        else:
+            recorder = self.engine.stop_recording()
+            if recorder.error is not None:
+                self.write_to_cmd(f"Recording failed: {recorder.error!r}, {recorder.bytes_written} bytes in {recorder.path}.")
+            else:
+                self.write_to_cmd(f"Recording stopped, {recorder.bytes_written} bytes written to {recorder.path}.")
+
+    def save_latency(self):
+        os.makedirs(RECORDINGS_DIR, exist_ok=True)
+        path = os.path.join(RECORDINGS_DIR, time.strftime("latency_%y%m%d_%H%M%S.json"))
+        self.tracer.dump(path)
+        self.write_to_cmd(f"Latency report saved to {path}.")
+
     def write_to_cmd(self, msg: str):
         previous_text = '\n'.join(self.cmd_display.toPlainText().split('\n')[-50:])
         self.cmd_display.setText(f"{previous_text}\n{msg}")
@@ -190,19 +272,17 @@ class MainWindow(QtWidgets.QMainWindow):
             return
         self.selected_ports.addItem(PortListWidgetItem(double_clicked_port.text()))
         self.available_ports.takeItem(self.available_ports.row(double_clicked_port))
-        self.scommand.sendall(f"set {double_clicked_port.text().lower()}.tcpdataoutputenabled true".encode())
+        self.engine.enable_channel(double_clicked_port.text())
         self.write_to_cmd(f"Analog port: {double_clicked_port.text()} has been activated.")
         self.available_ports.sortItems()
         self.selected_ports.sortItems()
         if self.selected_ports.count() == 2:
             self.calibrationButton.setEnabled(True)
-            self.scommand.sendall(b'set runmode run')
-        time.sleep(SERVER_WAIT)
 
     def remove_from_selected_ports(self, double_clicked_port):
         self.available_ports.addItem(PortListWidgetItem(double_clicked_port.text()))
         self.selected_ports.takeItem(self.selected_ports.row(double_clicked_port))
-        self.scommand.sendall(f"set {double_clicked_port.text().lower()}.tcpdataoutputenabled false".encode())
+        self.engine.disable_channel(double_clicked_port.text())
         self.write_to_cmd(f"Analog port: {double_clicked_port.text()} has been deactivated.")
         self.available_ports.sortItems()
         self.selected_ports.sortItems()
@@ -224,22 +304,15 @@ class MainWindow(QtWidgets.QMainWindow):
         #     asdf["time"], asdf["value"])
 
     def plot_time_domain_data(self):
-        # [([0, 1, 2, 3], [s1, s1, s1], [s2, s2, s2]), ([0, 1, 2, 3], [s1, s1, s1], [s2, s2, s2]), ....]
-        ts = [x[0] for x in self.rolling_data]  # [[0, 1, 2, 3], [0, 1, 2, 3], [0, 1, 2, 3]]
-        samp0 = [x[1] for x in self.rolling_data]  # [[s1, s1, s1], [s1, s1, s1], ...]
-        samp1 = [x[2] for x in self.rolling_data]
-        ts = list(itertools.chain(*ts))
-        samp0 = list(itertools.chain(*samp0))
-        samp1 = list(itertools.chain(*samp1))
+        timestamps, (samp0, samp1) = self.rolling_data.latest()
+        ts = timestamps * self.timestep
 
         # ts_all = list(ts[0])
         # for time_data in ts[1:]:
         #     ts_all.extend([x+ts_all[-1]+self.timestep for x in time_data])
 
-        self.plot_zone_td0.clear()
-        self.plot_zone_td1.clear()
-        self.plot_zone_td0.plot(ts, samp0, pen=pg.mkPen(color='r'))
-        self.plot_zone_td1.plot(ts, samp1, pen=pg.mkPen(color='b'))
+        self.curve_td0.setData(ts, samp0, skipFiniteCheck=True)
+        self.curve_td1.setData(ts, samp1, skipFiniteCheck=True)
 
     def plot_calibration_data(self):
         relax_data = list(zip(*self.calibration_data[StateMachineModes.CALIBRATE_P1_RELAX]))
@@ -293,13 +366,12 @@ class MainWindow(QtWidgets.QMainWindow):
             self.write_to_cmd(f"P2 Flex: {self.calibration_data[StateMachineModes.CALIBRATE_P2_FLEX]}")
             self._tick_count = 0
 
-            lflex = self.calibration_data[StateMachineModes.CALIBRATE_P1_FLEX]
-            lrelax = self.calibration_data[StateMachineModes.CALIBRATE_P1_RELAX]
-            rflex = self.calibration_data[StateMachineModes.CALIBRATE_P2_FLEX]
-            rrelax = self.calibration_data[StateMachineModes.CALIBRATE_P2_RELAX]
-
-            self.sig_processor.threshold1 = (lflex + lrelax) / 2
-            self.sig_processor.threshold_diff = (rflex + rrelax) / 2
+            self.engine.set_calibration(
+                lrelax=self.calibration_data[StateMachineModes.CALIBRATE_P1_RELAX],
+                lflex=self.calibration_data[StateMachineModes.CALIBRATE_P1_FLEX],
+                rrelax=self.calibration_data[StateMachineModes.CALIBRATE_P2_RELAX],
+                rflex=self.calibration_data[StateMachineModes.CALIBRATE_P2_FLEX],
+            )
 
             return
 
@@ -326,8 +398,8 @@ class MainWindow(QtWidgets.QMainWindow):
         # print(f"Samp 1 length:{len(samp1)}")
         # print(f"Rolling data length: {len(self.rolling_data)}")
         # self.tick()
-        thresh1 = np.mean(self.sig_processor.ints1[-200:])
-        thresh2 = np.mean(self.sig_processor.ints2[-200:])
+        thresh1 = self.engine.energy_level(0)
+        thresh2 = self.engine.energy_level(1)
 
         if self._mode == StateMachineModes.CALIBRATE_P1_RELAX:
             self.calibration_data[StateMachineModes.CALIBRATE_P1_RELAX] = thresh1
@@ -342,153 +414,75 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def tick(self):
         self.info.setText(f"Current State: {self._mode.value}")
+        if time.perf_counter() - self._last_latency_report >= LATENCY_REPORT_INTERVAL:
+            game = self.engine.game
+            game_info = f"Game: {game.fps:.0f} / {game.frame_rate:g} fps\n" if game is not None else ""
+            self.latency_info.setText(f"{game_info}Latency p50 / p95 / p99\n{self.tracer.summary()}")
+            self._last_latency_report = time.perf_counter()
+        if self.engine.recorder is not None and self.engine.recorder.error is not None:
+            # Stops the recording and reports the error through toggle_recording
+            self.recordButton.setChecked(False)
 
         if self.selected_ports.count() != 2:
-            self.scommand.sendall(b'get runmode')
-            time.sleep(SERVER_WAIT)
-            if (str(self.scommand.recv(COMMAND_BUFFER_SIZE), "utf-8") != "Return: RunMode Stop"):
-                self.scommand.sendall(b'set runmode stop')
+            # Only sends a command if the board is (or might be) running
+            self.engine.run_mode.ensure("Stop")
             self.gameButton.setEnabled(True)
             return
             # self.scommand.sendall(b'set runmode stop')
             # time.sleep(SERVER_WAIT)
-        data = []
-        raw_data = self.swaveform.recv(1028*16)
-        for block_data in raw_data.split(struct.pack("<I", 0x2ef07a08))[1:]:
-            # raw_sample[0] is the lowest selected channel
-            try:
-                for raw_timestamp, raw_samples0, raw_samples1 in struct.iter_unpack(f"<iHH", block_data):
-                    data.append(
-                        (
-                            raw_timestamp * self.timestep,
-                            (raw_samples0 - 32768)*0.195,
-                            (raw_samples1 - 32768)*0.195,
-                        ),
-                    )
-            except struct.error:
-                self.info.setText("data error, skipping data point")
-                return
-
-        ts, samp0, samp1 = zip(*data)
-
-        self.sig_processor.update(samp0, samp1)
-        self.sig_processor.plot()
-
-        control = self.sig_processor.controls[-1]
-        action = ACTIONS[control]
-
-
-        self.rolling_data = self.rolling_data[-20:] + [(ts, samp0, samp1)]
-        self.plot_time_domain_data()
-        # THIS 
-        if self.gameButton.isChecked() and any(x is not None for x in self.calibration_data.values()):
-            done = False
-            print("game actionable")
-            self.env.render()
-
-            # action = self.env.action_space.sample()
-            for x in range(12):
-                try:
-                    obs, reward, terminated, truncated, info = self.env.step(action)
-                except:
-                    state = self.env.reset()
-            done = terminated or truncated
-            # Run out of lives set done
-            if done:
-                state = self.env.reset()
-            # self.env.close()
-
+        # samples[0] is the lowest selected channel
+        timestamps, samples = self.gui_reader.read()
+        if len(timestamps) == 0:
+            return
 
+        self.rolling_data.write(timestamps, samples)
+        self.plot_time_domain_data()
 
                 #self.plot_zone_td1.plot(np.abs(np.fft.fft(samp0))**2, pen=pg.mkPen(color='m'))
                 #self.plot_zone_td1.plot(np.abs(np.fft.fft(samp1))**2, pen=pg.mkPen(color='w'))
         # if self._tick_count * TICK_INTERVAL == CALIBRATION_ELAPSED:
                 # self.plot_calibration_data()
-                
-    def begin_game(self):
-        pass
-
 
-def main():
-    print('Connecting to TCP command server...')
-    scommand = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    while True:
-        try:
-            scommand.connect(('127.0.0.1', 5000))
-        except ConnectionRefusedError:
-            print("Connection to TCP command server unsucessful.\n Trying again...")
-            time.sleep(1)
-        else:
-            break
-
-    print('Connecting to TCP waveform server...')
-    swaveform = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    while True:
-        try:
-            swaveform.connect(('127.0.0.1', 5001))
-        except ConnectionRefusedError:
-            print("Connection to TCP waveform server unsuccessful.\n Trying again...")
-            time.sleep(1)
+    def begin_game(self, checked):
+        # The game process steps itself at its own frame rate, the GUI only starts and stops it
+        if self.engine.game is None:
+            return
+        if checked:
+            self.engine.game.play()
         else:
-            break
-    
-    scommand.sendall(b'get runmode')
-    commandReturn = str(scommand.recv(COMMAND_BUFFER_SIZE), "utf-8")
-    isStopped = commandReturn == "Return: RunMode Stop"
-
-    if not isStopped:
-        scommand.sendall(b'set runmode stop')
-        time.sleep(SERVER_WAIT)
-
-    scommand.sendall(b'get sampleratehertz')
-    commandReturn = str(scommand.recv(COMMAND_BUFFER_SIZE), "utf-8")
-    expectedReturnString = "Return: SampleRateHertz "
-    if commandReturn.find(expectedReturnString) == -1: # Look for "Return: SampleRateHertz N" where N is the sample rate
-        raise Exception('Unable to get sample rate from server')
-    else:
-        sampleRate = float(commandReturn[len(expectedReturnString):])
-
-    timestep = 1 / sampleRate
+            self.engine.game.pause()
 
-    scommand.sendall(b"set notchfilterfreqhertz 60")
-    time.sleep(SERVER_WAIT)
 
-    scommand.sendall(b"set dspenabled true")
-    time.sleep(SERVER_WAIT)
+def print_startup_report(startup):
+    startup.mark("window shown")
+    print(startup.report())
 
-    scommand.sendall(b"set desireddspcutofffreqhertz 20")
-    time.sleep(SERVER_WAIT)
-
-    scommand.sendall(b"set desiredlowerbandwidthhertz 2")
-    time.sleep(SERVER_WAIT)
-
-    scommand.sendall(b"set desiredupperbandwidthhertz 450")
-    time.sleep(SERVER_WAIT)
-
-    scommand.sendall(b"get actuallowerbandwidthhertz")
-    print(str(scommand.recv(COMMAND_BUFFER_SIZE), "utf-8"))
-    scommand.sendall(b"get actualupperbandwidthhertz")
-    print(str(scommand.recv(COMMAND_BUFFER_SIZE), "utf-8"))
-    scommand.sendall(b"execute updatebandwidthsettings")
-    print(str(scommand.recv(COMMAND_BUFFER_SIZE), "utf-8"))
-    scommand.sendall(b'execute clearalldataoutputs')
-    time.sleep(SERVER_WAIT)
 
+def main():
+    startup = StartupTimer(STARTED)
+    startup.mark("imports")
+    # The game process loads the emulator while the server is configured and ports are selected
+    game = GameProcess(render_mode="human", max_hold=ACTION_MAX_HOLD, tracer=LatencyTracer(shared=True), started=STARTED)
+    game.start()
+
+    scommand, swaveform = connect()
+    client = CommandClient(scommand)
+    startup.mark("connected")
+    timestep = configure_server(client)
+    startup.mark("server configured")
+    engine = ControllerEngine(client, swaveform, timestep, threshold1=50, threshold_diff=35, game=game)
 
     app = QtWidgets.QApplication([])
-    window = MainWindow(scommand, swaveform, timestep)
+    window = MainWindow(engine)
+    startup.mark("window created")
     window.show()
+    # Fires on the first pass of the event loop, i.e. once the window is actually up
+    QtCore.QTimer.singleShot(0, partial(print_startup_report, startup))
     app.exec()
 
-    scommand.sendall(b'get runmode')
-    commandReturn = str(scommand.recv(COMMAND_BUFFER_SIZE), "utf-8")
-    isStopped = commandReturn == "Return: RunMode Stop"
-
-    if not isStopped:
-        scommand.sendall(b'set runmode stop')
-        time.sleep(0.1)
+    stop_server(client)
 
 
 if __name__ == '__main__':
-    # run("main()", sort="cumtime")
+    # import cProfile; cProfile.run("main()", sort="cumtime")
     main()
\ No newline at end of file
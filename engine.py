@@ -0,0 +1,330 @@
+"""Headless EMG game controller: acquisition, features, classifier and game driver.
+
+ControllerEngine owns everything needed to play from EMG without a window. The Qt GUI
+in ece202_hack.py drives the same engine from its timers and only observes its state,
+while this module runs it from a plain loop:
+
+    python engine.py --ports A-015 A-021 --threshold1 50 --threshold-diff 35
+    python engine.py --ports A-015 A-021 --calibrate --render --duration 120
+
+The game runs in its own process (see game.py). Without --game the controller runs but
+no emulator is started, which is useful for recording sessions (--record) or measuring
+latency (--latency-report) on lab machines.
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+
+from acquisition import AcquisitionThread
+from command_client import CommandClient, CommandError, RunModeTracker
+from features import FEATURES
+from game import GameProcess, FRAME_RATE
+from latency import LatencyTracer
+from plot_emg import SignalProcessor, tail
+from recorder import Recorder, RECORDING_EXTENSION
+
+
+COMMAND_TIMEOUT = 2
+
+TICK_INTERVAL = 0.1
+CONTROL_INTERVAL = 0.02
+# Mario stops if the controller hasn't produced an action for this long
+ACTION_MAX_HOLD = 0.5
+CALIBRATION_ELAPSED = 5
+# Control updates averaged for a calibration level, the whole CALIBRATION_ELAPSED
+CALIBRATION_SAMPLES = round(CALIBRATION_ELAPSED / CONTROL_INTERVAL)
+RECORDINGS_DIR = "recordings"
+FEATURE_COLUMNS = [f"{name}{ch}" for name in FEATURES for ch in range(2)]
+
+ACTIONS = {
+    0: 0,  # relaxed -> no movement
+    1: 1,  # right arm -> move right
+    2: 6,  # left arm -> move left
+    3: 5,  # both arms -> move right and jump
+}
+
+# (prompt, channel whose energy is measured) in the order the GUI calibrates
+CALIBRATION_STEPS = (
+    ("Left Arm Relax", 0),
+    ("Left Arm Flex", 0),
+    ("Right Arm Relax", 1),
+    ("Right Arm Flex", 1),
+)
+
+
+def connect(host="127.0.0.1", command_port=5000, waveform_port=5001):
+    """Connect to the RHX command and waveform servers, retrying until they are up."""
+    sockets = []
+    for name, port in (("command", command_port), ("waveform", waveform_port)):
+        print(f'Connecting to TCP {name} server...')
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        while True:
+            try:
+                s.connect((host, port))
+            except ConnectionRefusedError:
+                print(f"Connection to TCP {name} server unsuccessful.\n Trying again...")
+                time.sleep(1)
+            else:
+                break
+        sockets.append(s)
+    return sockets
+
+
+def configure_server(client, timeout=COMMAND_TIMEOUT):
+    """Stop the board, apply the EMG filter settings and return the sample period.
+
+    All commands go out in one write; only the replies are waited for.
+    """
+    with client.batch():
+        client.set("runmode", "stop")
+        rate = client.get("sampleratehertz")
+        commands = [
+            client.set("notchfilterfreqhertz", 60),
+            client.set("dspenabled", "true"),
+            client.set("desireddspcutofffreqhertz", 20),
+            client.set("desiredlowerbandwidthhertz", 2),
+            client.set("desiredupperbandwidthhertz", 450),
+        ]
+        lower = client.get("actuallowerbandwidthhertz")
+        upper = client.get("actualupperbandwidthhertz")
+        commands.append(client.execute("updatebandwidthsettings"))
+        commands.append(client.execute("clearalldataoutputs"))
+        done = client.sync()
+
+    try:
+        sampleRate = float(rate.result(timeout))
+    except (CommandError, ValueError) as e:
+        raise Exception('Unable to get sample rate from server') from e
+    done.result(timeout)
+    for command in commands:
+        if command.exception() is not None:
+            print(command.exception())
+    print(f"Bandwidth {lower.result(timeout)} - {upper.result(timeout)} Hz")
+    return 1 / sampleRate
+
+
+def stop_server(client, timeout=COMMAND_TIMEOUT):
+    client.set("runmode", "stop")
+    client.sync().result(timeout)
+    client.close()
+
+
+def make_signal_processor(timestep, threshold1=50, threshold_diff=35, ma_window=None, flip=False):
+    """SignalProcessor updating once per CONTROL_INTERVAL of samples, as the engine runs it.
+
+    ma_window counts control updates and defaults to the GUI's 3 ticks of TICK_INTERVAL.
+    """
+    # Controls update every CONTROL_INTERVAL, keep the same history and smoothing in seconds
+    control_ticks = round(TICK_INTERVAL / CONTROL_INTERVAL)
+    return SignalProcessor(maxlen=50*control_ticks, threshold1=threshold1, threshold_diff=threshold_diff,
+                           ma_window=3*control_ticks if ma_window is None else ma_window, flip=flip,
+                           feature_window=round(CONTROL_INTERVAL / timestep))
+
+
+class ControllerEngine:
+    """Turns the EMG stream of two channels into game actions.
+
+    control_step() decodes whatever arrived since the last call, updates the classifier
+    and hands the resulting action to the game process. It can be called from a GUI
+    timer or from run(), which paces it on its own.
+    """
+
+    def __init__(self, client, swaveform, timestep, threshold1=50, threshold_diff=35, game=None,
+                 n_channels=2, tracer=None):
+        self.client = client
+        self.run_mode = RunModeTracker(client)
+        self.run_mode.refresh()
+        self.swaveform = swaveform
+        self.timestep = timestep
+        self.n_channels = n_channels
+        self.game = game
+
+        self.sig_processor = make_signal_processor(timestep, threshold1, threshold_diff)
+
+        # Stage timings from sample arrival to env.step, see latency.STAGES. The game
+        # process records env_step and total into the shared tracer it was created with.
+        self.tracer = tracer or getattr(game, "tracer", None) or LatencyTracer()
+        self.action = ACTIONS[0]
+        self.action_arrival = None
+        self.channels = []
+        self.recorder = None
+        self.acquisition = AcquisitionThread(swaveform, n_channels=n_channels, tracer=self.tracer)
+        self.control_reader = self.acquisition.reader()
+        self.acquisition.start()
+        self._stop_event = threading.Event()
+
+    @property
+    def active(self):
+        return len(self.channels) == self.n_channels
+
+    def enable_channel(self, name):
+        """Stream channel name (e.g. "A-015"); the board starts once all channels are selected."""
+        self.channels.append(name)
+        with self.client.batch():
+            self.client.set(f"{name.lower()}.tcpdataoutputenabled", "true")
+            if self.active:
+                self.run_mode.set("Run")
+
+    def disable_channel(self, name):
+        self.channels.remove(name)
+        self.client.set(f"{name.lower()}.tcpdataoutputenabled", "false")
+        self.run_mode.ensure("Stop")
+
+    def control_step(self):
+        # Runs on its own short interval so control decisions don't wait for plotting
+        timestamps, samples = self.control_reader.read()
+        if not self.active or len(timestamps) == 0:
+            return None
+        self.tracer.record_since("queue", self.control_reader.last_arrival)
+        # One update per CONTROL_INTERVAL of samples, however the socket chunked them
+        with self.tracer.measure("update"):
+            features = self.sig_processor.update_block(samples)
+
+        if self.sig_processor.controls:
+            with self.tracer.measure("control"):
+                self.action = ACTIONS[self.sig_processor.controls[-1]]
+            self.action_arrival = self.control_reader.last_arrival
+            if self.game is not None:
+                self.game.set_action(self.action, self.action_arrival)
+
+        if self.recorder is not None:
+            n = features["mav"].shape[1]
+            if n:
+                self.recorder.write_features(np.concatenate([features[name] for name in FEATURES]).T)
+                for tick, control in zip(tail(self.sig_processor.ticks, n), tail(self.sig_processor.controls, n)):
+                    self.recorder.write_control(int(tick), int(control), ACTIONS[int(control)])
+        return features
+
+    def energy_level(self, channel):
+        """Mean recent integrated energy of channel 0 or 1, used as a calibration point."""
+        ints = self.sig_processor.ints1 if channel == 0 else self.sig_processor.ints2
+        return np.mean(tail(ints, CALIBRATION_SAMPLES))
+
+    def set_calibration(self, lrelax, lflex, rrelax, rflex):
+        self.sig_processor.threshold1 = (lflex + lrelax) / 2
+        self.sig_processor.threshold_diff = (rflex + rrelax) / 2
+
+    def calibrate(self, seconds=CALIBRATION_ELAPSED, announce=print):
+        """Run the relax/flex calibration sequence from the console and set the thresholds."""
+        levels = []
+        for prompt, channel in CALIBRATION_STEPS:
+            announce(f"Beginning calibration for {prompt}.")
+            self.run(seconds, game=False)
+            levels.append(self.energy_level(channel))
+            announce(f"Calibration for {prompt} completed: {levels[-1]:.2f}")
+        self.set_calibration(*levels)
+        announce(f"Thresholds: {self.sig_processor.threshold1:.2f} / {self.sig_processor.threshold_diff:.2f}")
+
+    def start_recording(self, path=None):
+        if path is None:
+            os.makedirs(RECORDINGS_DIR, exist_ok=True)
+            path = os.path.join(RECORDINGS_DIR, time.strftime("session_%y%m%d_%H%M%S") + RECORDING_EXTENSION)
+        self.recorder = Recorder(path, n_channels=self.n_channels, sample_rate=1 / self.timestep,
+                                 feature_columns=FEATURE_COLUMNS, metadata={"actions": ACTIONS})
+        self.recorder.start()
+        self.acquisition.recorder = self.recorder
+        return path
+
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        self.acquisition.recorder = None
+        recorder.stop()
+        return recorder
+
+    def run(self, duration=None, game=True):
+        """Call control_step every CONTROL_INTERVAL, with the game playing if game is set.
+
+        Returns after duration seconds, or when stop() is called if duration is None.
+        """
+        if game and self.game is not None:
+            self.game.play()
+        start = next_control = time.perf_counter()
+        try:
+            while not self._stop_event.is_set():
+                now = time.perf_counter()
+                if duration is not None and now - start >= duration:
+                    break
+                self.control_step()
+                # Skip missed steps rather than running them back to back
+                next_control = max(next_control + CONTROL_INTERVAL, now)
+                time.sleep(max(0, next_control - time.perf_counter()))
+        finally:
+            if self.game is not None:
+                self.game.pause()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def close(self):
+        self.stop()
+        if self.recorder is not None:
+            self.stop_recording()
+        self.acquisition.stop()
+        if self.game is not None:
+            self.game.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ports", nargs=2, default=["A-015", "A-021"], help="channels to stream, the lower one is the left arm")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--command-port", type=int, default=5000)
+    parser.add_argument("--waveform-port", type=int, default=5001)
+    parser.add_argument("--threshold1", type=float, default=50)
+    parser.add_argument("--threshold-diff", type=float, default=35)
+    parser.add_argument("--calibrate", action="store_true", help="run the relax/flex calibration first")
+    parser.add_argument("--game", action=argparse.BooleanOptionalAction, default=True, help="play Super Mario Bros")
+    parser.add_argument("--render", action="store_true", help="show the game window")
+    parser.add_argument("--frame-rate", type=float, default=FRAME_RATE)
+    parser.add_argument("--frame-skip", type=int, default=1, help="frames each action is held for")
+    parser.add_argument("--render-every", type=int, default=1, help="render every k-th frame")
+    parser.add_argument("--max-hold", type=float, default=ACTION_MAX_HOLD,
+                        help="seconds without a new action before Mario stops")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run, default until Ctrl-C")
+    parser.add_argument("--record", nargs="?", const="", default=None, help="record the session (optional path)")
+    parser.add_argument("--latency-report", help="write latency percentiles to this JSON file on exit")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    # Started first, so the emulator loads while the server is configured
+    game = None
+    if args.game:
+        game = GameProcess("human" if args.render else None, frame_rate=args.frame_rate, frame_skip=args.frame_skip,
+                           render_every=args.render_every, max_hold=args.max_hold,
+                           tracer=LatencyTracer(shared=True), started=started)
+        game.start()
+    scommand, swaveform = connect(args.host, args.command_port, args.waveform_port)
+    client = CommandClient(scommand)
+    timestep = configure_server(client)
+    engine = ControllerEngine(client, swaveform, timestep, args.threshold1, args.threshold_diff, game=game)
+    try:
+        # Lowest channel first, like the GUI's sorted port list
+        for name in sorted(args.ports):
+            engine.enable_channel(name)
+        if args.record is not None:
+            print(f"Recording to {engine.start_recording(args.record or None)}.")
+        if args.calibrate:
+            engine.calibrate()
+        engine.run(args.duration, game=args.game)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if game is not None:
+            print(f"Game: {game.fps:.1f} / {game.frame_rate:g} fps, {game.render_fps:.1f} rendered")
+        if engine.recorder is not None:
+            recorder = engine.stop_recording()
+            if recorder.error is not None:
+                print(f"Recording failed: {recorder.error!r}, {recorder.bytes_written} bytes in {recorder.path}.")
+        engine.close()
+        print(engine.tracer.summary())
+        if args.latency_report:
+            engine.tracer.dump(args.latency_report)
+        stop_server(client)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""Offline evaluation of controller settings on recorded EMG sessions.
+
+Replays each recording through the same SignalProcessor the live engine runs, turns the
+controls into actions and plays them into a headless Super Mario Bros at FRAME_RATE
+frames per second of recording time. Every (recording, parameter set) pair is an
+independent job on a process pool, so a whole grid runs in one batch:
+
+    python evaluate.py data/raw/botharms_230301_155959/botharms_230301_160059.rhd \\
+        --threshold1 40 50 60 --threshold-diff 25 35 45 --json results.json
+    python evaluate.py recordings/*.emgrec --actions 0,1,6,5 0,1,6,2 --workers 8
+
+Sources are anything replay_server.py can stream: .rhd files, exported CSV session
+directories and .emgrec recordings. For each job it reports the furthest x_pos reached,
+deaths (lost lives), flags reached, game reward, action switches and the controller's
+latency: the cost of one update, and the delay from the end of the samples behind a new
+action to the first frame that plays it. --no-game only runs the controller, which
+doesn't need the emulator.
+"""
+import argparse
+import functools
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from engine import ACTIONS, CONTROL_INTERVAL, make_signal_processor
+from game import FRAME_RATE, NOOP_ACTION, make_env
+from latency import LatencyTracer
+from plot_emg import tail
+from replay_server import ReplaySource, arm_channels
+from waveform import ADC_OFFSET, MICROVOLTS_PER_BIT
+
+
+PARAMETERS = ("threshold1", "threshold_diff", "ma_window", "flip", "actions")
+
+
+@functools.lru_cache(maxsize=4)
+def load_emg(path, channels=None, seconds=None):
+    """(sample_rate, 2 x n microvolts) of a recording, as the replay server would stream it.
+
+    With seconds, the recording is looped or cut to that length. Cached per process, so
+    a pool worker only reads each recording once.
+    """
+    source = ReplaySource(path)
+    indices = arm_channels(path, source.channel_names, channels)
+    n = source.n_samples if seconds is None else round(seconds * source.sample_rate)
+    raw = source.read(0, n, indices)
+    return source.sample_rate, (raw.astype(np.float32) - ADC_OFFSET) * MICROVOLTS_PER_BIT
+
+
+def run_controller(samples, sample_rate, threshold1, threshold_diff, ma_window=None, flip=False):
+    """Controls and the times their samples ended, feeding CONTROL_INTERVAL chunks like the engine.
+
+    Returns (controls, times in seconds, LatencyTracer with the update stage).
+    """
+    sig_processor = make_signal_processor(1 / sample_rate, threshold1, threshold_diff, ma_window, flip)
+    extractor = sig_processor.extractor
+    chunk = round(CONTROL_INTERVAL * sample_rate)
+    # One update per chunk, the last one partial, so the ring never wraps
+    tracer = LatencyTracer(("update",), capacity=max(-(-samples.shape[1] // chunk), 1))
+    controls = []
+    for start in range(0, samples.shape[1], chunk):
+        with tracer.measure("update"):
+            features = sig_processor.update_block(samples[:, start:start + chunk])
+        n = features["mav"].shape[1]
+        if n:
+            controls.extend(tail(sig_processor.controls, n))
+    times = (np.arange(len(controls)) * extractor.hop + extractor.window) / sample_rate
+    return np.array(controls, dtype=np.int64), times, tracer
+
+
+def frame_actions(controls, times, actions, n_frames, frame_skip=1):
+    """Action of every frame, holding the latest control like FrameScheduler does."""
+    frame_times = np.arange(n_frames) // frame_skip * frame_skip / FRAME_RATE
+    latest = np.searchsorted(times, frame_times, side="right") - 1
+    if not len(controls):
+        # Shorter than one feature window, no control ever arrives
+        return np.full(n_frames, NOOP_ACTION), latest
+    lookup = np.array([actions[c] for c in range(4)])
+    return np.where(latest >= 0, lookup[controls[np.maximum(latest, 0)]], NOOP_ACTION), latest
+
+
+def action_delays(times, latest, actions_per_frame, updates):
+    """Seconds from the end of a new action's samples to the first frame that plays it."""
+    changed = np.flatnonzero(np.diff(actions_per_frame) != 0) + 1
+    changed = changed[latest[changed] >= 0]
+    control = latest[changed]
+    # Live, the action only exists once its update has finished
+    return changed / FRAME_RATE - times[control] + updates[np.minimum(control, len(updates) - 1)]
+
+
+def play(env, actions_per_frame):
+    """Step env through the actions, counting lives lost and flags reached."""
+    max_x = deaths = flags = 0
+    reward_total = 0.0
+    life = None
+    for action in actions_per_frame:
+        obs, reward, terminated, truncated, info = env.step(int(action))
+        reward_total += reward
+        max_x = max(max_x, info.get("x_pos", 0))
+        flags += bool(info.get("flag_get", False))
+        lost = life is not None and info.get("life", life) < life
+        deaths += lost
+        life = info.get("life")
+        if terminated or truncated:
+            # Game over doesn't always show up as a lower life count
+            deaths += terminated and not lost and not info.get("flag_get", False)
+            env.reset()
+            life = None
+    return {"max_x": int(max_x), "deaths": int(deaths), "flags": int(flags), "reward": float(reward_total)}
+
+
+def evaluate(path, params, channels=None, seconds=None, game=True, frame_skip=1, env_id='SuperMarioBros-v1',
+             movement="SIMPLE_MOVEMENT"):
+    """Run one recording with one parameter set, returning a flat result dict."""
+    sample_rate, samples = load_emg(path, channels, seconds)
+    controls, times, tracer = run_controller(samples, sample_rate, params["threshold1"], params["threshold_diff"],
+                                             params["ma_window"], params["flip"])
+    n_frames = int(samples.shape[1] / sample_rate * FRAME_RATE)
+    actions_per_frame, latest = frame_actions(controls, times, params["actions"], n_frames, frame_skip)
+    updates = tracer.durations("update")
+    delays = action_delays(times, latest, actions_per_frame, updates)
+
+    result = {
+        "recording": path,
+        **{name: params[name] for name in PARAMETERS},
+        "seconds": samples.shape[1] / sample_rate,
+        "frames": n_frames,
+        "controls": np.bincount(controls, minlength=4).tolist(),
+        "switches": len(delays),
+        "update_p50_ms": float(np.percentile(updates, 50) * 1e3) if len(updates) else 0.0,
+        "update_p99_ms": float(np.percentile(updates, 99) * 1e3) if len(updates) else 0.0,
+        "delay_ms": float(delays.mean() * 1e3) if len(delays) else 0.0,
+    }
+    if game:
+        env = make_env(env_id, movement)
+        try:
+            start = time.perf_counter()
+            result.update(play(env, actions_per_frame))
+            result["game_fps"] = n_frames / (time.perf_counter() - start)
+        finally:
+            env.close()
+    return result
+
+
+def parameter_grid(args):
+    for threshold1, threshold_diff, ma_window, flip, actions in itertools.product(
+            args.threshold1, args.threshold_diff, args.ma_window, args.flip, args.actions):
+        yield {"threshold1": threshold1, "threshold_diff": threshold_diff, "ma_window": ma_window,
+               "flip": flip, "actions": actions}
+
+
+def parse_actions(text):
+    """"0,1,6,5" -> {0: 0, 1: 1, 2: 6, 3: 5}, the action of each control like engine.ACTIONS."""
+    values = [int(value) for value in text.split(",")]
+    if len(values) != 4:
+        raise argparse.ArgumentTypeError("need one action per control 0-3, e.g. 0,1,6,5")
+    return dict(enumerate(values))
+
+
+def format_result(result):
+    line = (f"{os.path.basename(result['recording']):<30} t1={result['threshold1']:<6g} td={result['threshold_diff']:<6g}"
+            f" ma={result['ma_window']!s:<4} flip={int(result['flip'])} actions={','.join(map(str, result['actions'].values()))}"
+            f"  switches={result['switches']:<4} update={result['update_p50_ms']:.3f}/{result['update_p99_ms']:.3f} ms"
+            f" delay={result['delay_ms']:.1f} ms")
+    if "max_x" in result:
+        line += f"  x={result['max_x']:<5} deaths={result['deaths']} flags={result['flags']} reward={result['reward']:g}"
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recordings", nargs="+")
+    parser.add_argument("--channels", nargs=2, default=None,
+                        help="channels to replay, left arm first (default: the first two recorded)")
+    parser.add_argument("--seconds", type=float, default=None,
+                        help="replay this long, looping short recordings (default: once through)")
+    parser.add_argument("--threshold1", type=float, nargs="+", default=[50])
+    parser.add_argument("--threshold-diff", type=float, nargs="+", default=[35])
+    parser.add_argument("--ma-window", type=int, nargs="+", default=[None], help="moving average in control updates")
+    parser.add_argument("--flip", type=int, nargs="+", choices=(0, 1), default=[0], help="swap the arms")
+    parser.add_argument("--actions", type=parse_actions, nargs="+", default=[ACTIONS],
+                        help="action of each control 0-3, e.g. 0,1,6,5")
+    parser.add_argument("--game", action=argparse.BooleanOptionalAction, default=True, help="play the actions")
+    parser.add_argument("--frame-skip", type=int, default=1, help="frames each action is held for")
+    parser.add_argument("--env-id", default='SuperMarioBros-v1')
+    parser.add_argument("--movement", default="SIMPLE_MOVEMENT")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--json", help="write all results to this JSON file")
+    args = parser.parse_args()
+    args.flip = [bool(flip) for flip in args.flip]
+    channels = tuple(args.channels) if args.channels else None
+    for path in args.recordings:
+        # Checked here rather than failing in the workers once the pool is busy
+        try:
+            arm_channels(path, ReplaySource(path).channel_names, channels)
+        except ValueError as e:
+            parser.error(str(e))
+
+    jobs = [(path, params) for path in args.recordings for params in parameter_grid(args)]
+    print(f"Evaluating {len(jobs)} jobs")
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(args.workers) as pool:
+        futures = [pool.submit(evaluate, path, params, channels, args.seconds, args.game, args.frame_skip,
+                               args.env_id, args.movement)
+                   for path, params in jobs]
+        for future in futures:
+            results.append(future.result())
+            print(format_result(results[-1]), flush=True)
+    print(f"Done in {time.perf_counter() - start:.1f} s")
+
+    if args.game:
+        best = max(results, key=lambda r: (r["max_x"], -r["deaths"]))
+        print(f"Furthest: {format_result(best)}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
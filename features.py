@@ -0,0 +1,87 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+FEATURES = ("mav", "rms", "wl", "zc", "ssc")
+
+
+def n_windows(n_samples, window, hop):
+    return max((n_samples - window) // hop + 1, 0)
+
+
+def window_features(samples, window, hop, threshold=0.0):
+    """Time-domain EMG features on a fixed window/hop grid.
+
+    samples is a (n_channels, n) array. Windows start at 0, hop, 2*hop, ... and only
+    complete windows are used. Returns a dict mapping each name in FEATURES to a
+    (n_channels, n_windows) array:
+
+    mav: mean absolute value, rms: root mean square, wl: waveform length,
+    zc: zero crossings, ssc: slope sign changes. Differences smaller than threshold
+    are not counted as crossings or slope changes.
+    """
+    samples = np.atleast_2d(samples)
+    n_channels, n = samples.shape
+    count = n_windows(n, window, hop)
+    if count == 0:
+        return {name: np.empty((n_channels, 0)) for name in FEATURES}
+
+    # Per-sample (and per-pair / per-triple) terms, each summed over every window through
+    # a single strided view, so all five features take one pass over the block
+    x = samples.astype(np.float64, copy=False)
+    dx = np.diff(x, axis=-1)
+    amplitude = np.stack([np.abs(x), np.square(x)])
+    pairs = np.stack([
+        np.abs(dx),
+        (x[:, :-1] * x[:, 1:] < 0) & (np.abs(dx) >= threshold),
+    ])
+    triples = dx[:, :-1] * -dx[:, 1:] > threshold
+
+    amplitude = _window_sums(amplitude, window, hop, count)
+    pairs = _window_sums(pairs, window - 1, hop, count)
+    triples = _window_sums(triples, window - 2, hop, count)
+    return {
+        "mav": amplitude[0] / window,
+        "rms": np.sqrt(amplitude[1] / window),
+        "wl": pairs[0],
+        "zc": pairs[1],
+        "ssc": triples,
+    }
+
+
+def _window_sums(terms, length, hop, count):
+    if length <= 0:
+        return np.zeros(terms.shape[:-1] + (count,))
+    windows = sliding_window_view(terms, length, axis=-1)[..., :count * hop:hop, :]
+    return windows.sum(axis=-1, dtype=np.float64)
+
+
+class FeatureExtractor:
+    """Streams window_features over blocks of any length.
+
+    Samples that do not yet fill a window are carried over to the next call, and with
+    hop > window the gap up to the next window start is skipped in later calls, so the
+    feature grid only depends on window and hop, never on how the stream was chunked.
+    """
+
+    def __init__(self, n_channels, window, hop=None, threshold=0.0):
+        self.n_channels = n_channels
+        self.window = window
+        self.hop = window if hop is None else hop
+        self.threshold = threshold
+        self._carry = np.empty((n_channels, 0), dtype=np.float32)
+        # Samples still to drop before the next window starts
+        self._skip = 0
+
+    def process(self, samples):
+        if self._skip:
+            skipped = min(self._skip, samples.shape[1])
+            samples = samples[:, skipped:]
+            self._skip -= skipped
+        buffer = np.concatenate([self._carry, samples], axis=1) if self._carry.shape[1] else samples
+        features = window_features(buffer, self.window, self.hop, self.threshold)
+        consumed = features["mav"].shape[1] * self.hop
+        n = buffer.shape[1]
+        self._carry = np.array(buffer[:, min(consumed, n):], dtype=np.float32)
+        self._skip += max(consumed - n, 0)
+        return features
@@ -0,0 +1,234 @@
+"""Super Mario Bros in its own process, stepped at a fixed frame rate.
+
+The controller only writes the latest action into a shared-memory slot; the game
+process reads it once per frame. Emulation and rendering therefore never delay EMG
+acquisition or control, and the game runs at FRAME_RATE however fast controls arrive.
+"""
+import multiprocessing as mp
+import time
+
+
+FRAME_RATE = 60
+NOOP_ACTION = 0
+# Seconds of frames the loop may fall behind before it gives up catching up
+MAX_BACKLOG = 0.25
+
+
+def make_env(env_id='SuperMarioBros-v1', movement="SIMPLE_MOVEMENT"):
+    # gym and the emulator are only imported in the process that plays the game
+    import gym
+    import gym_super_mario_bros
+    from gym_super_mario_bros import actions
+    from nes_py.wrappers import JoypadSpace
+
+    # No render_mode: the compatibility wrapper would render on every step and reset.
+    # Callers render themselves with render_env(), on the frames they choose.
+    env = gym.make(env_id, apply_api_compatibility=True, render_mode=None)
+    env = JoypadSpace(env, getattr(actions, movement))
+    env.reset()
+    return env
+
+
+def render_env(env):
+    """Show the current frame in the game window, opening it on first use."""
+    env.unwrapped.render(mode="human")
+
+
+class FrameScheduler:
+    """Wall-clock pacing for a frame loop, with action holds and render skipping.
+
+    A new action is taken from the controller every frame_skip frames and held in
+    between. An action that was last set more than max_hold seconds ago is replaced by
+    NOOP_ACTION, so a stalled controller doesn't leave Mario running. Every
+    render_every-th frame is rendered. While the loop is behind the wall clock, frames
+    are stepped without rendering until it has caught up, so slow machines keep the
+    game speed and drop rendered frames instead.
+
+        scheduler.start()
+        while playing:
+            scheduler.wait()
+            env.step(scheduler.action(latest_action, set_at))
+            if scheduler.should_render():
+                render_env(env)
+            scheduler.frame_done()
+    """
+
+    def __init__(self, frame_rate=FRAME_RATE, frame_skip=1, render_every=1, max_hold=None, report_interval=1.0):
+        self.frame_rate = frame_rate
+        self.period = 1 / frame_rate
+        self.frame_skip = frame_skip
+        self.render_every = render_every
+        self.max_hold = max_hold
+        self.report_interval = report_interval
+        self.frame = 0
+        self.behind = False
+        self.fps = 0.0
+        self.render_fps = 0.0
+        self._held = NOOP_ACTION
+        self._rendering = False
+        self.start()
+
+    def start(self):
+        """Restart the clock, e.g. after the loop was paused."""
+        self._next_frame = time.perf_counter()
+        self._report_start = self._next_frame
+        self._report_frames = self._report_renders = 0
+
+    def wait(self):
+        """Sleep until the next frame is due."""
+        now = time.perf_counter()
+        if now < self._next_frame:
+            time.sleep(self._next_frame - now)
+            now = time.perf_counter()
+        self.behind = now - self._next_frame > self.period
+        if now - self._next_frame > MAX_BACKLOG:
+            # Too far behind to catch up, run slower instead
+            self._next_frame = now
+        self._next_frame += self.period
+
+    def action(self, latest, set_at=None):
+        """Action for this frame, given the controller's latest action and when it was set."""
+        if self.frame % self.frame_skip == 0:
+            stale = self.max_hold is not None and set_at is not None and time.perf_counter() - set_at > self.max_hold
+            self._held = NOOP_ACTION if stale else latest
+        return self._held
+
+    def should_render(self):
+        self._rendering = self.frame % self.render_every == 0 and not self.behind
+        return self._rendering
+
+    def frame_done(self):
+        self.frame += 1
+        self._report_frames += 1
+        self._report_renders += self._rendering
+        elapsed = time.perf_counter() - self._report_start
+        if elapsed >= self.report_interval:
+            self.fps = self._report_frames / elapsed
+            self.render_fps = self._report_renders / elapsed
+            self._report_start += elapsed
+            self._report_frames = self._report_renders = 0
+
+    def report(self):
+        return f"{self.fps:.1f} / {self.frame_rate:g} fps, {self.render_fps:.1f} rendered"
+
+
+class GameProcess(mp.Process):
+    """Plays the game from the action slot while play() is in effect.
+
+    frame_rate, frame_skip, render_every and max_hold configure its FrameScheduler.
+    tracer, if given, must be a LatencyTracer(shared=True); the process records the
+    env_step stage and the total latency from the arrival of the samples behind an
+    action to the first frame that uses it.
+    """
+
+    def __init__(self, render_mode="human", env_id='SuperMarioBros-v1', movement="SIMPLE_MOVEMENT",
+                 frame_rate=FRAME_RATE, frame_skip=1, render_every=1, max_hold=None, tracer=None, started=None):
+        super().__init__(name="game", daemon=True)
+        self.render_mode = render_mode
+        self.env_args = (env_id, movement)
+        self.scheduler_args = (frame_rate, frame_skip, render_every, max_hold)
+        self.tracer = tracer
+        # Startup reference (perf_counter in the parent) for the "ready" message
+        self.started = started
+        # action, perf_counter time the samples that produced it arrived (0 if unknown),
+        # perf_counter time it was set
+        self._slot = mp.Array("d", [NOOP_ACTION, 0, 0])
+        self._n_actions = mp.Value("i", 0)
+        self._fps = mp.Value("d", 0.0)
+        self._render_fps = mp.Value("d", 0.0)
+        self._frames = mp.Value("q", 0)
+        self._playing = mp.Event()
+        self._ready = mp.Event()
+        self._stop_event = mp.Event()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    @property
+    def n_actions(self):
+        return self._n_actions.value
+
+    @property
+    def fps(self):
+        return self._fps.value
+
+    @property
+    def render_fps(self):
+        return self._render_fps.value
+
+    @property
+    def frame_rate(self):
+        return self.scheduler_args[0]
+
+    @property
+    def frames(self):
+        return self._frames.value
+
+    @property
+    def playing(self):
+        return self._playing.is_set()
+
+    def set_action(self, action, arrival=None):
+        with self._slot.get_lock():
+            self._slot[0] = action
+            self._slot[1] = arrival or 0
+            self._slot[2] = time.perf_counter()
+
+    def play(self):
+        self._playing.set()
+
+    def pause(self):
+        self._playing.clear()
+
+    def stop(self, timeout=5):
+        self._stop_event.set()
+        self._playing.set()
+        self.join(timeout)
+        if self.is_alive():
+            self.terminate()
+
+    def run(self):
+        env = make_env(*self.env_args)
+        self._n_actions.value = env.action_space.n
+        self._ready.set()
+        if self.started is not None:
+            print(f"Game environment ready after {(time.perf_counter() - self.started) * 1e3:.0f} ms")
+
+        scheduler = FrameScheduler(*self.scheduler_args)
+        last_arrival = 0
+        try:
+            while not self._stop_event.is_set():
+                if not self._playing.is_set():
+                    self._playing.wait(0.1)
+                    scheduler.start()
+                    continue
+                scheduler.wait()
+
+                with self._slot.get_lock():
+                    latest, arrival, set_at = int(self._slot[0]), self._slot[1], self._slot[2]
+                action = scheduler.action(latest, set_at)
+                step_start = time.perf_counter()
+                try:
+                    obs, reward, terminated, truncated, info = env.step(action)
+                except Exception:
+                    # Kept from the GUI loop: an env that refuses to step (e.g. after game over) is reset
+                    env.reset()
+                    continue
+                if self.tracer is not None:
+                    self.tracer.record_since("env_step", step_start)
+                    if arrival != last_arrival and arrival and action == latest:
+                        self.tracer.record_since("total", arrival)
+                        last_arrival = arrival
+                if self.render_mode == "human" and scheduler.should_render():
+                    render_env(env)
+                # Run out of lives
+                if terminated or truncated:
+                    env.reset()
+
+                scheduler.frame_done()
+                self._frames.value += 1
+                self._fps.value = scheduler.fps
+                self._render_fps.value = scheduler.render_fps
+        finally:
+            env.close()
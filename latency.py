@@ -0,0 +1,135 @@
+"""Always-on latency tracing for the acquisition -> control -> game pipeline.
+
+Each stage keeps the last `capacity` durations in a preallocated array, so recording a
+measurement is one perf_counter call and an array store. Percentiles are only computed
+when a summary is requested.
+"""
+import json
+import multiprocessing as mp
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+STAGES = ("decode", "queue", "update", "control", "env_step", "total")
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyTracer:
+    def __init__(self, stages=STAGES, capacity=4096, shared=False):
+        self.capacity = capacity
+        self._stages = list(stages)
+        self._index = {stage: i for i, stage in enumerate(self._stages)}
+        # Shared tracers live in shared memory, so a game process can record its own stages
+        if shared:
+            self._raw = (mp.RawArray("d", len(self._stages) * capacity), mp.RawArray("q", len(self._stages)))
+        else:
+            self._raw = None
+        self._init_arrays()
+
+    def _init_arrays(self):
+        if self._raw is None:
+            self._durations = np.zeros((len(self._stages), self.capacity))
+            self._counts = np.zeros(len(self._stages), dtype=np.int64)
+        else:
+            durations, counts = self._raw
+            self._durations = np.frombuffer(durations, dtype=np.float64).reshape(len(self._stages), self.capacity)
+            self._counts = np.frombuffer(counts, dtype=np.int64)
+
+    def __getstate__(self):
+        # Rebuild the views on the other side instead of pickling copies of the arrays
+        state = self.__dict__.copy()
+        if self._raw is not None:
+            del state["_durations"], state["_counts"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._raw is not None:
+            self._init_arrays()
+
+    @property
+    def stages(self):
+        return list(self._stages)
+
+    def count(self, stage):
+        return int(self._counts[self._index[stage]])
+
+    def record(self, stage, seconds):
+        # One writer per stage, so stages can be recorded from different threads or processes
+        i = self._index[stage]
+        count = self._counts[i]
+        self._durations[i, count % self.capacity] = seconds
+        self._counts[i] = count + 1
+
+    def record_since(self, stage, start):
+        self.record(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def durations(self, stage):
+        i = self._index[stage]
+        return self._durations[i, :min(self._counts[i], self.capacity)]
+
+    def percentiles(self, stage, q=PERCENTILES):
+        """Percentiles of the recent durations of a stage in milliseconds."""
+        durations = self.durations(stage)
+        if len(durations) == 0:
+            return [float("nan")] * len(q)
+        return [float(p) for p in np.percentile(durations, q) * 1e3]
+
+    def summary(self):
+        lines = []
+        for stage in self.stages:
+            if self.count(stage):
+                p50, p95, p99 = self.percentiles(stage)
+                lines.append(f"{stage}: {p50:.2f} / {p95:.2f} / {p99:.2f} ms")
+        return "\n".join(lines)
+
+    def report(self):
+        return {
+            stage: {
+                "count": self.count(stage),
+                **{f"p{q}_ms": value for q, value in zip(PERCENTILES, self.percentiles(stage))},
+            }
+            for stage in self.stages
+        }
+
+    def dump(self, path):
+        """Write percentiles and the raw recent durations (seconds) of every stage as JSON."""
+        report = self.report()
+        for stage in self.stages:
+            report[stage]["durations"] = self.durations(stage).tolist()
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1)
+
+
+class StartupTimer:
+    """Named milestones since process start, printed once the UI is up."""
+
+    def __init__(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.marks = []
+
+    def elapsed(self):
+        """Milliseconds since start."""
+        return (time.perf_counter() - self.start) * 1e3
+
+    def mark(self, name):
+        # list.append is atomic, so background threads can mark too
+        self.marks.append((name, self.elapsed()))
+
+    def report(self):
+        lines = ["Startup timing:"]
+        previous = 0
+        for name, at in self.marks:
+            lines.append(f"  {name:<24} {at:8.0f} ms  (+{at - previous:.0f} ms)")
+            previous = at
+        return "\n".join(lines)
@@ -1,10 +1,11 @@
 from nes_py.wrappers import JoypadSpace
 import gym_super_mario_bros
 from gym_super_mario_bros.actions import SIMPLE_MOVEMENT
-env = gym_super_mario_bros.make('SuperMarioBros-v0', apply_api_compatibility=True, render_mode="human")
+# Rendered by render_env below, a "human" render_mode would also render on every step
+env = gym_super_mario_bros.make('SuperMarioBros-v0', apply_api_compatibility=True, render_mode=None)
 env = JoypadSpace(env, SIMPLE_MOVEMENT)
 
-import time
+from game import FrameScheduler, FRAME_RATE, render_env
 
 
 def choose_action(a):
@@ -13,17 +14,26 @@ def choose_action(a):
     else:
         return 1
 
+# Real-time pacing against the wall clock instead of sleeping a fixed 10 ms per step
+scheduler = FrameScheduler(frame_rate=FRAME_RATE, render_every=1)
+
 done = True
 action=1
 for step in range(5000):
     if done:
         state = env.reset()
+        scheduler.start()
+    scheduler.wait()
     # action = env.action_space.sample()#\
     # action = choose_action(action)
     action = 6
-    obs, state, reward, done, info = env.step(action)
-    time.sleep(0.01)
+    obs, reward, terminated, truncated, info = env.step(scheduler.action(action))
+    done = terminated or truncated
     space = env.action_space
-    env.render()
+    if scheduler.should_render():
+        render_env(env)
+    scheduler.frame_done()
+    if step % FRAME_RATE == 0:
+        print(scheduler.report())
 
-env.close()
\ No newline at end of file
+env.close()
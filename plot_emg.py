@@ -1,40 +1,74 @@
-import matplotlib.pyplot as plt
+import itertools
+import os
+import sys
+from collections import deque
+
 import numpy as np
 
+from features import FeatureExtractor
+from rhd import RhdRecording
+from session import load_session
+from recorder import read_recording, RECORDING_EXTENSION
+
 
-def moving_average(a, n=3):
-    ret = np.cumsum(a, dtype=float)
-    ret[n:] = ret[n:] - ret[:-n]
-    ma = ret[n - 1:] / n
-    pad = np.zeros(n-1) * np.nan
-    ma = np.concatenate([pad, ma])
+def moving_average(a, n=3, dtype=float):
+    """Trailing n-sample mean along the last axis, NaN until n samples are available.
+
+    a may be 1-D or channels x samples; all channels are processed in one call.
+    """
+    ret = np.cumsum(a, axis=-1, dtype=dtype)
+    np.subtract(ret[..., n:], ret[..., :-n], out=ret[..., n:])
+    ma = np.full(ret.shape, np.nan, dtype=dtype)
+    np.divide(ret[..., n - 1:], n, out=ma[..., n - 1:])
     return ma
 
 
-def integrate(a, n_buckets=60):
-    a = np.power(a, 2)
-    n = a.shape[0]
-    buckets = []
-    for i in range(n_buckets):
-        start = i
-        stop = i + 1
+def integrate(a, n_buckets=60, dtype=float):
+    """Energy (sum of squares) of n_buckets equal slices along the last axis.
+
+    a may be 1-D or channels x samples; all channels are processed in one call.
+    """
+    a = np.asarray(a)
+    n = a.shape[-1]
+    buckets = np.zeros(a.shape[:-1] + (n_buckets,), dtype=dtype)
+    if n == 0:
+        return buckets
+
+    left = (np.arange(n_buckets) / n_buckets * n).astype(np.intp)
+    right = np.append(left[1:], n)
+    filled = right > left
+    squared = np.square(a, dtype=dtype)
+    # reduceat returns a[left] for empty buckets, so only fill the non-empty ones
+    buckets[..., filled] = np.add.reduceat(squared, left, axis=-1)[..., filled]
+    return buckets
+
+
+def tail(values, n):
+    """Last n entries of a deque (or any sized iterable) as an array."""
+    return np.fromiter(itertools.islice(values, max(len(values) - n, 0), None), dtype=float)
+
 
-        left = int(start / n_buckets * n)
-        right = int(stop / n_buckets * n)
+class RunningSum:
+    """Sum over the last `window` values pushed, updated in constant time."""
 
-        data = a[left:right]
-        integrated = np.sum(np.abs(data))
-        buckets.append(integrated)
+    def __init__(self, window):
+        self.values = deque(maxlen=window)
+        self.total = 0.0
 
-    return np.array(buckets)
+    def push(self, x):
+        if len(self.values) == self.values.maxlen:
+            self.total -= self.values[0]
+        self.values.append(x)
+        self.total += x
+        return self.total
 
 
 class SignalProcessor:
-    def __init__(self, maxlen=50, ma_window=None, threshold1 = 0, threshold_diff = 0, flip=False):
-        self.fig, axs = plt.subplots(3)
-        self.ax1 = axs[0]
-        self.ax2 = axs[1]
-        self.ax3 = axs[2]
+    def __init__(self, maxlen=50, ma_window=None, threshold1 = 0, threshold_diff = 0, flip=False,
+                 feature_window=None, feature_hop=None, feature_threshold=0.0):
+        # The matplotlib figure is only created on the first call to plot(), live views
+        # draw SignalProcessor state with pyqtgraph instead
+        self.fig = None
 
         self.threshold1 = threshold1
         self.threshold_diff = threshold_diff
@@ -43,23 +77,49 @@ class SignalProcessor:
 
         self.ma_window = maxlen if ma_window is None else ma_window
 
-        self.ints1 = []
-        self.ints2 = []
-        self.diff = []
+        # Histories are bounded deques, moving averages use running sums over the last
+        # ma_window values so update() costs the same no matter how long it has run
+        self.ints1 = deque(maxlen=maxlen)
+        self.ints2 = deque(maxlen=maxlen)
+        self.diff = deque(maxlen=maxlen)
         self.tick_count = 0
-        self.ticks = []
+        self.ticks = deque(maxlen=maxlen)
 
-        self.ma_int1 = []
-        self.ma_int2 = []
-        self.ma_diff = []
+        self.ma_int1 = deque(maxlen=maxlen)
+        self.ma_int2 = deque(maxlen=maxlen)
+        self.ma_diff = deque(maxlen=maxlen)
 
-        self.controls = []
+        self.controls = deque(maxlen=maxlen)
+
+        window = min(self.ma_window, maxlen)
+        self._sum_int1 = RunningSum(window)
+        self._sum_int2 = RunningSum(window)
+        self._sum_diff = RunningSum(window)
+
+        # Needed by update_block, which steps on a fixed grid of feature_window samples
+        self.extractor = None
+        if feature_window is not None:
+            self.extractor = FeatureExtractor(2, feature_window, feature_hop, feature_threshold)
 
     def update(self, samp0, samp1):
 
-        int1 = np.sum(np.abs(np.array(samp0))) / len(samp0)
-        int2 = np.sum(np.abs(np.array(samp1))) / len(samp1)
+        int1 = float(np.abs(samp0).mean())
+        int2 = float(np.abs(samp1).mean())
+        self.update_energies(int1, int2)
+
+    def update_block(self, samples):
+        """Feed a (2, n) block of any length, updating once per complete feature window.
+
+        Returns the features computed for the block (see features.window_features).
+        """
+        if self.extractor is None:
+            raise ValueError("update_block needs SignalProcessor(feature_window=...)")
+        features = self.extractor.process(samples)
+        for int1, int2 in features["mav"].T:
+            self.update_energies(float(int1), float(int2))
+        return features
 
+    def update_energies(self, int1, int2):
         if self.flip:
             int1, int2 = int2, int1
 
@@ -72,9 +132,9 @@ class SignalProcessor:
         self.tick_count += 1
         self.ticks.append(self.tick_count)
 
-        ma_diff = self.moving_average(self.diff)
-        ma_int1 = self.moving_average(self.ints1)
-        ma_int2 = self.moving_average(self.ints2)
+        ma_diff = self._sum_diff.push(diff) / self.ma_window
+        ma_int1 = self._sum_int1.push(int1) / self.ma_window
+        ma_int2 = self._sum_int2.push(int2) / self.ma_window
 
         self.ma_int1.append(ma_int1)
         self.ma_int2.append(ma_int2)
@@ -88,20 +148,13 @@ class SignalProcessor:
         control = int(control_bin, 2)
         self.controls.append(control)
 
-        if len(self.ints1) > self.maxlen:
-            self.ints1 = self.ints1[-self.maxlen:]
-            self.ints2 = self.ints2[-self.maxlen:]
-            self.ticks = self.ticks[-self.maxlen:]
-            self.diff = self.diff[-self.maxlen:]
-            self.ma_int1 = self.ma_int1[-self.maxlen:]
-            self.ma_int2 = self.ma_int2[-self.maxlen:]
-            self.ma_diff = self.ma_diff[-self.maxlen:]
-            self.controls = self.controls[-self.maxlen:]
+    def plot(self):
+        # Imported here so the live and headless controllers never load matplotlib
+        import matplotlib.pyplot as plt
 
-    def moving_average(self, s):
-        return np.sum(s[-self.ma_window:]) / self.ma_window
+        if self.fig is None:
+            self.fig, (self.ax1, self.ax2, self.ax3) = plt.subplots(3)
 
-    def plot(self):
         self.ax1.clear()
         self.ax2.clear()
         self.ax3.clear()
@@ -124,8 +177,9 @@ class SignalProcessor:
 
 
 def main():
-    PATH = "data/botharms_230301_155959/amplifier_data.txt"
-    T_PATH = "data/botharms_230301_155959/t_amplifier.txt"
+    import matplotlib.pyplot as plt
+
+    PATH = sys.argv[1] if len(sys.argv) > 1 else "data/raw/botharms_230301_155959/botharms_230301_160059.rhd"
     fig, axs = plt.subplots(4)
     fig.tight_layout()
     ax1 = axs[0]
@@ -133,16 +187,24 @@ def main():
     ax3 = axs[2]
     ax4 = axs[3]
 
-    data = np.loadtxt(PATH)
-    ts = np.loadtxt(T_PATH)
-
+    # Seconds from the start of the file, only this range is read from disk
     START = 0
     STOP = 60
 
-    LEFT = int(START / 60 * data.shape[1])
-    RIGHT = int(STOP / 60 * data.shape[1])
-    data = data[:, LEFT:RIGHT]
-    ts = ts[LEFT:RIGHT]
+    if PATH.endswith(RECORDING_EXTENSION):
+        # Live session written by the controller's record mode
+        recording = read_recording(PATH)
+        t = recording["timestamps"] / recording["metadata"]["sample_rate"]
+        left, right = np.searchsorted(t, [t[0] + START, t[0] + STOP])
+        ts, data = t[left:right], recording["samples"][:, left:right]
+    elif os.path.isdir(PATH):
+        # CSV export, converted to a memory-mapped cache on first use
+        session = load_session(PATH)
+        start_time = session.t_amplifier[0]
+        ts, data = session.read(start_time + START, start_time + STOP)
+    else:
+        recording = RhdRecording(PATH)
+        ts, data = recording.read(recording.start_time + START, recording.start_time + STOP)
 
     ax1.plot(ts, data[0], label="Signal 1")
     ax1.set_title("Raw Signal Streams")
@@ -157,12 +219,10 @@ def main():
     # ax2.plot(ts, ma3)
 
     # ingegrations
-    i1 = integrate(data[0], 600)
-    i2 = integrate(data[1], 600)
+    i1, i2 = integrate(data[:2], 600)
     t_ints = list(range(600))
 
-    ma1 = moving_average(i1, 20)
-    ma2 = moving_average(i2, 20)
+    ma1, ma2 = moving_average(np.stack([i1, i2]), 20)
     ax2.plot(t_ints, ma1, label="Signal 1 Energy")
     ax2.plot(t_ints, ma2, label="Signal 2 Energy")
     # ax2.plot(t_ints, i1 - i2)
@@ -0,0 +1,110 @@
+"""Labels from the recording protocols written next to the raw sessions.
+
+A protocol file describes timed phases in plain text, e.g. botharms.txt:
+
+    10s Relax, 10s Both arms flexed, 10s Relax, 10s Right arm flexed left arm relaxed, ...
+
+or leftarm.txt, one phase per line and a repeat instruction:
+
+    First 10 seconds relax
+    Next 10 seconds squeezing hand
+    Repeat for 1 minute
+
+Labels use the controller's classes (see engine.ACTIONS), so a label can be compared
+with SignalProcessor controls directly.
+"""
+import os
+import re
+
+import numpy as np
+
+
+RELAX, RIGHT, LEFT, BOTH = 0, 1, 2, 3
+LABEL_NAMES = ("relax", "right", "left", "both")
+UNLABELLED = -1
+
+DURATION = re.compile(r"(\d+(?:\.\d+)?)\s*(s|sec|secs|seconds?|min|minutes?)\b", re.IGNORECASE)
+REPEAT = re.compile(r"\brepeat\b", re.IGNORECASE)
+ACTIVE = r"(?:flex\w*|squeez\w*|contract\w*)"
+# "Right arm flexed", "squeezing left hand"
+SIDE_ACTIVE = (r"\b{side}\s+(?:arms?|hands?)\s+" + ACTIVE
+               + r"|" + ACTIVE + r"\s+(?:the\s+)?{side}\s+(?:arms?|hands?)(?!\s+relax)")
+
+
+def _seconds(match):
+    value, unit = float(match.group(1)), match.group(2).lower()
+    return value * 60 if unit.startswith("min") else value
+
+
+def phase_label(text, active=None):
+    """Label of one phase description; active is the label of a flex that names no side."""
+    text = text.lower()
+    if not re.search(ACTIVE, text):
+        if re.search(r"\b(?:relax\w*|rest(?:ing)?)\b", text):
+            return RELAX
+        raise ValueError(f"Can't tell what {text!r} means")
+    if re.search(r"\bboth\b", text):
+        return BOTH
+    sides = [label for side, label in (("right", RIGHT), ("left", LEFT))
+             if re.search(SIDE_ACTIVE.format(side=side), text)]
+    if len(sides) == 2:
+        return BOTH
+    if sides:
+        return sides[0]
+    if active is None:
+        raise ValueError(f"{text!r} doesn't say which arm, pass active=")
+    return active
+
+
+def parse_protocol(text, active=None):
+    """[(seconds, label), ...] phases of a protocol description, repeats expanded."""
+    phases = []
+    repeat_until = None
+    for part in re.split(r"[,\n;]", text):
+        part = part.strip()
+        duration = DURATION.search(part)
+        if not part or duration is None:
+            continue
+        if REPEAT.search(part):
+            repeat_until = _seconds(duration)
+            continue
+        phases.append((_seconds(duration), phase_label(part, active)))
+    if not phases:
+        raise ValueError("No timed phases in protocol")
+
+    if repeat_until is not None:
+        cycle, total = list(phases), sum(seconds for seconds, _ in phases)
+        while total < repeat_until:
+            for seconds, label in cycle:
+                seconds = min(seconds, repeat_until - total)
+                if seconds <= 0:
+                    break
+                phases.append((seconds, label))
+                total += seconds
+    return phases
+
+
+def read_protocol(path, active=None):
+    """Phases of a protocol file. A flex without a side defaults to the arm in the file name."""
+    if active is None:
+        name = os.path.basename(path).lower()
+        active = LEFT if "left" in name else RIGHT if "right" in name else BOTH if "both" in name else None
+    with open(path) as f:
+        return parse_protocol(f.read(), active)
+
+
+def find_protocol(path):
+    """The protocol .txt next to a recording (or inside a session directory), or None."""
+    directory = path if os.path.isdir(path) else os.path.dirname(path)
+    texts = sorted(name for name in os.listdir(directory or ".") if name.endswith(".txt"))
+    return os.path.join(directory, texts[0]) if len(texts) == 1 else None
+
+
+def protocol_labels(t, phases, offset=0.0):
+    """Label of every sample time in t, UNLABELLED outside the protocol.
+
+    offset is the time on t's clock at which the protocol started.
+    """
+    bounds = offset + np.cumsum([0] + [seconds for seconds, _ in phases])
+    values = np.array([UNLABELLED] + [label for _, label in phases] + [UNLABELLED], dtype=np.int8)
+    return values[np.searchsorted(bounds, t, side="right")]
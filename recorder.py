@@ -0,0 +1,173 @@
+"""Append-only recording of a live session: samples, features and controls.
+
+File layout: an 8 byte magic, a <I length and a JSON metadata header, then records of
+<4sII (kind, payload bytes, rows) followed by the payload. The file grows in
+preallocated, zero-filled chunks, so reading stops at the first all-zero record header.
+"""
+import json
+import os
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+
+
+RECORDING_MAGIC = b"EMGREC01"
+RECORDING_EXTENSION = ".emgrec"
+RECORD_HEADER = struct.Struct("<4sII")
+
+SAMPLES = b"SAMP"
+FEATURES = b"FEAT"
+CONTROLS = b"CTRL"
+
+CONTROL_DTYPE = np.dtype([("time", "<f8"), ("tick", "<i8"), ("control", "<i4"), ("action", "<i4")])
+
+CHUNK_SIZE = 16 * 2**20
+FSYNC_INTERVAL = 1.0
+
+
+class Recorder(threading.Thread):
+    """Writes a session to disk from a background thread.
+
+    write_samples / write_features / write_control only put the arrays on a queue, so
+    calling them from the acquisition or control path costs a few microseconds. If the
+    writer fails, the exception is kept in error, later writes are dropped and stop()
+    returns it.
+    """
+
+    def __init__(self, path, n_channels=2, sample_rate=None, feature_columns=(), metadata=None):
+        super().__init__(name="recorder", daemon=True)
+        self.path = path
+        self.n_channels = n_channels
+        self.feature_columns = list(feature_columns)
+        self.metadata = {
+            "n_channels": n_channels,
+            "sample_rate": sample_rate,
+            "feature_columns": self.feature_columns,
+            "created": time.time(),
+            **(metadata or {}),
+        }
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._end = 0
+        self._allocated = 0
+        self.bytes_written = 0
+        self.error = None
+
+    def write_samples(self, timestamps, samples):
+        if self.error is None:
+            self._queue.put((SAMPLES, np.asarray(timestamps, dtype="<i4"), np.asarray(samples, dtype="<f4")))
+
+    def write_features(self, rows):
+        if self.error is None:
+            self._queue.put((FEATURES, np.ascontiguousarray(np.atleast_2d(rows), dtype="<f4")))
+
+    def write_control(self, tick, control, action):
+        if self.error is None:
+            row = np.array([(time.time(), tick, control, action)], dtype=CONTROL_DTYPE)
+            self._queue.put((CONTROLS, row))
+
+    def stop(self, timeout=5):
+        """Finish the file, returning the exception that stopped the writer, if any."""
+        self._queue.put(None)
+        self.join(timeout)
+        return self.error
+
+    def run(self):
+        try:
+            with open(self.path, "wb+") as self._file:
+                self._write_header()
+                last_sync = time.monotonic()
+                while True:
+                    try:
+                        item = self._queue.get(timeout=FSYNC_INTERVAL)
+                    except queue.Empty:
+                        item = ()
+                    if item is None:
+                        break
+                    if item:
+                        self._write_record(*item)
+                    if time.monotonic() - last_sync >= FSYNC_INTERVAL:
+                        self._sync()
+                        last_sync = time.monotonic()
+                # Drop the unused part of the last preallocated chunk
+                self._file.flush()
+                self._file.truncate(self._end)
+                self._sync()
+        except Exception as e:
+            self.error = e
+            # Nothing will write what's left, don't hold on to it
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+    def _write_header(self):
+        header = json.dumps(self.metadata).encode()
+        self._append(RECORDING_MAGIC + struct.pack("<I", len(header)) + header)
+
+    def _write_record(self, kind, *arrays):
+        rows = len(arrays[0])
+        if kind == SAMPLES:
+            timestamps, samples = arrays
+            arrays = (timestamps, np.ascontiguousarray(samples.reshape(self.n_channels, rows)))
+        payload = sum(a.nbytes for a in arrays)
+        self._append(RECORD_HEADER.pack(kind, payload, rows), *arrays)
+
+    def _append(self, *parts):
+        size = sum(len(p) if isinstance(p, bytes) else p.nbytes for p in parts)
+        if self._end + size > self._allocated:
+            self._allocated = self._end + size + CHUNK_SIZE
+            self._file.truncate(self._allocated)
+        self._file.seek(self._end)
+        for part in parts:
+            self._file.write(part if isinstance(part, bytes) else memoryview(part).cast("B"))
+        self._end += size
+        self.bytes_written = self._end
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+
+def read_recording(path):
+    """Load a recording written by Recorder.
+
+    Returns a dict with metadata, timestamps (int32), samples (channels x samples
+    float32), features (rows x feature_columns float32) and controls (CONTROL_DTYPE).
+    """
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    if bytes(data[:8]) != RECORDING_MAGIC:
+        raise ValueError(f"{path} is not an EMG recording")
+    (header_size,) = struct.unpack("<I", bytes(data[8:12]))
+    metadata = json.loads(bytes(data[12:12 + header_size]))
+    n_channels = metadata["n_channels"]
+    n_columns = len(metadata["feature_columns"])
+
+    timestamps, samples, features, controls = [], [], [], []
+    pos = 12 + header_size
+    while pos + RECORD_HEADER.size <= len(data):
+        kind, payload, rows = RECORD_HEADER.unpack(bytes(data[pos:pos + RECORD_HEADER.size]))
+        if kind == b"\0\0\0\0":
+            break
+        pos += RECORD_HEADER.size
+        body = data[pos:pos + payload]
+        if kind == SAMPLES:
+            timestamps.append(body[:4 * rows].view("<i4"))
+            samples.append(body[4 * rows:].view("<f4").reshape(n_channels, rows))
+        elif kind == FEATURES:
+            features.append(body.view("<f4").reshape(rows, n_columns))
+        elif kind == CONTROLS:
+            controls.append(body.view(CONTROL_DTYPE))
+        pos += payload
+
+    return {
+        "metadata": metadata,
+        "timestamps": np.concatenate(timestamps) if timestamps else np.empty(0, dtype=np.int32),
+        "samples": np.concatenate(samples, axis=1) if samples else np.empty((n_channels, 0), dtype=np.float32),
+        "features": np.concatenate(features) if features else np.empty((0, n_columns), dtype=np.float32),
+        "controls": np.concatenate(controls) if controls else np.empty(0, dtype=CONTROL_DTYPE),
+    }
@@ -0,0 +1,322 @@
+"""Stand-in for the Intan RHX TCP servers that replays a recorded session.
+
+Speaks the subset of the command protocol used by ece202.py on the command port and
+streams magic-word framed waveform blocks on the waveform port, at real time or any
+multiple of it:
+
+    python replay_server.py data/raw/botharms_230301_155959/botharms_230301_160059.rhd --speed 4
+
+Sources can be .rhd files, exported CSV session directories or .emgrec recordings.
+The recording loops until the server is stopped. --sample-rate advertises and paces a
+different rate than the recording's, which is how the decoder and control loop can be
+load tested at rates the hardware would not produce.
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+
+from recorder import read_recording, RECORDING_EXTENSION
+from rhd import RhdRecording
+from session import load_session
+from waveform import FRAMES_PER_BLOCK, MAGIC_NUMBER, ADC_OFFSET, MICROVOLTS_PER_BIT, block_dtype
+
+
+COMMAND_BUFFER_SIZE = 1024
+SEND_INTERVAL = 0.01
+
+# Lower case parameter -> name used in "Return:" replies
+PARAMETER_NAMES = {
+    "runmode": "RunMode",
+    "sampleratehertz": "SampleRateHertz",
+    "notchfilterfreqhertz": "NotchFilterFreqHertz",
+    "dspenabled": "DspEnabled",
+    "desireddspcutofffreqhertz": "DesiredDspCutoffFreqHertz",
+    "actualdspcutofffreqhertz": "ActualDspCutoffFreqHertz",
+    "desiredlowerbandwidthhertz": "DesiredLowerBandwidthHertz",
+    "desiredupperbandwidthhertz": "DesiredUpperBandwidthHertz",
+    "actuallowerbandwidthhertz": "ActualLowerBandwidthHertz",
+    "actualupperbandwidthhertz": "ActualUpperBandwidthHertz",
+}
+# execute actions the clients send; only clearalldataoutputs changes anything here
+EXECUTE_ACTIONS = ("clearalldataoutputs", "updatebandwidthsettings")
+ACTUAL_FROM_DESIRED = {
+    "actualdspcutofffreqhertz": "desireddspcutofffreqhertz",
+    "actuallowerbandwidthhertz": "desiredlowerbandwidthhertz",
+    "actualupperbandwidthhertz": "desiredupperbandwidthhertz",
+}
+
+
+def arm_channels(path, channel_names, channels=None):
+    """Indices of the left and right arm channels of a recording, for offline scoring.
+
+    channels names them, left arm first (default: the first two recorded). A recording
+    with a single channel or an unknown name raises ValueError, since the controller
+    needs a separate signal for each arm.
+    """
+    if len(channel_names) < 2:
+        raise ValueError(f"{path} has {len(channel_names)} channel(s) ({', '.join(channel_names)}), "
+                         f"the controller needs one per arm")
+    return ReplaySource.indices_of(path, channel_names, channels or channel_names[:2])
+
+
+class ReplaySource:
+    """Raw uint16 amplifier samples from a recording, looping at the end."""
+
+    def __init__(self, path):
+        self.path = path
+        if path.endswith(".rhd"):
+            recording = RhdRecording(path)
+            self.sample_rate = recording.sample_rate
+            self.channel_names = [name.lower() for name in recording.channel_names]
+            self.n_samples = recording.n_samples
+            self._read = lambda start, stop, indices: recording.read_raw(start, stop, indices)[1]
+            return
+
+        if path.endswith(RECORDING_EXTENSION):
+            recording = read_recording(path)
+            self.sample_rate = recording["metadata"]["sample_rate"]
+            self.channel_names = [f"a-{i:03}" for i in range(recording["metadata"]["n_channels"])]
+            microvolts = recording["samples"]
+        elif os.path.isdir(path):
+            session = load_session(path)
+            self.sample_rate = session.sample_rate
+            self.channel_names = [name.lower() for name in session.channel_names]
+            microvolts = session.amplifier_data
+        else:
+            raise ValueError(f"Don't know how to replay {path}")
+        self.n_samples = microvolts.shape[1]
+        self._read = lambda start, stop, indices: to_raw(microvolts[indices, start:stop])
+
+    def channel_indices(self, names):
+        return self.indices_of(self.path, self.channel_names, names)
+
+    @staticmethod
+    def indices_of(path, channel_names, names):
+        names = [name.lower() for name in names]
+        missing = [name for name in names if name not in channel_names]
+        if missing:
+            raise ValueError(f"{path} has no channel {', '.join(missing)}, recorded: {', '.join(channel_names)}")
+        return [channel_names.index(name) for name in names]
+
+    def read(self, start, n, indices):
+        """n samples starting at sample start (wrapping around the recording)."""
+        out = np.empty((len(indices), n), dtype=np.uint16)
+        filled = 0
+        while filled < n:
+            pos = (start + filled) % self.n_samples
+            count = min(n - filled, self.n_samples - pos)
+            out[:, filled:filled + count] = self._read(pos, pos + count, indices)
+            filled += count
+        return out
+
+
+def to_raw(microvolts):
+    return np.clip(np.round(np.asarray(microvolts) / MICROVOLTS_PER_BIT) + ADC_OFFSET, 0, 65535).astype(np.uint16)
+
+
+def pack_blocks(first_timestamp, raw):
+    """Frame channels x (k * 128) raw samples as waveform blocks."""
+    n_channels, n = raw.shape
+    blocks = np.empty(n // FRAMES_PER_BLOCK, dtype=block_dtype(n_channels))
+    blocks["magic"] = MAGIC_NUMBER
+    # Assign through blocks["frames"] directly, reshaping that field would copy it
+    frames = blocks["frames"]
+    timestamps = np.arange(first_timestamp, first_timestamp + n, dtype=np.int64).astype(np.int32)
+    frames["timestamp"] = timestamps.reshape(len(blocks), FRAMES_PER_BLOCK)
+    frames["samples"] = raw.T.reshape(len(blocks), FRAMES_PER_BLOCK, n_channels)
+    return blocks.tobytes()
+
+
+class ReplayServer:
+    def __init__(self, source, host="127.0.0.1", command_port=5000, waveform_port=5001, speed=1.0,
+                 sample_rate=None):
+        self.source = source
+        self.speed = speed
+        self.host = host
+        self.command_port = command_port
+        self.waveform_port = waveform_port
+        self.parameters = {
+            "runmode": "Stop",
+            "sampleratehertz": f"{sample_rate or source.sample_rate:g}",
+            "notchfilterfreqhertz": "None",
+            "dspenabled": "False",
+            "desireddspcutofffreqhertz": "1",
+            "desiredlowerbandwidthhertz": "0.1",
+            "desiredupperbandwidthhertz": "7500",
+        }
+        self.enabled_channels = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._threads = []
+        self.blocks_sent = 0
+
+    @property
+    def sample_rate(self):
+        return float(self.parameters["sampleratehertz"])
+
+    @property
+    def running(self):
+        return self.parameters["runmode"] == "Run"
+
+    def start(self):
+        for target, port in ((self._serve_commands, self.command_port), (self._serve_waveform, self.waveform_port)):
+            listener = socket.create_server((self.host, port))
+            listener.settimeout(0.2)
+            thread = threading.Thread(target=target, args=(listener,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(1)
+
+    def _accept(self, listener):
+        while not self._stop_event.is_set():
+            try:
+                conn, _ = listener.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(0.2)
+            return conn
+        return None
+
+    def _serve_commands(self, listener):
+        with listener:
+            while (conn := self._accept(listener)) is not None:
+                with conn:
+                    text = ""
+                    while not self._stop_event.is_set():
+                        try:
+                            data = conn.recv(COMMAND_BUFFER_SIZE)
+                        except socket.timeout:
+                            continue
+                        except OSError:
+                            break
+                        if not data:
+                            break
+                        *commands, text = (text + data.decode()).replace("\n", ";").split(";")
+                        # Unterminated commands are complete unless the read filled the buffer,
+                        # clients that send one command per write don't terminate them
+                        if len(data) < COMMAND_BUFFER_SIZE:
+                            commands.append(text)
+                            text = ""
+                        for command in commands:
+                            reply = self.handle_command(command.strip())
+                            if reply:
+                                conn.sendall(reply.encode())
+
+    def handle_command(self, command):
+        """Apply one command and return the reply (None for commands without one)."""
+        if not command:
+            return None
+        words = command.split()
+        verb = words[0].lower()
+        with self._lock:
+            if verb == "get" and len(words) == 2:
+                return self._get(words[1].lower())
+            if verb == "set" and len(words) == 3:
+                return self._set(words[1].lower(), words[2])
+            if verb == "execute" and len(words) == 2 and words[1].lower() in EXECUTE_ACTIONS:
+                if words[1].lower() == "clearalldataoutputs":
+                    self.enabled_channels.clear()
+                return None
+        return f"Error: Unrecognized command: {command}"
+
+    def _get(self, parameter):
+        if parameter in ACTUAL_FROM_DESIRED:
+            value = self.parameters[ACTUAL_FROM_DESIRED[parameter]]
+        elif parameter in self.parameters:
+            value = self.parameters[parameter]
+        else:
+            return f"Error: Unrecognized parameter {parameter}"
+        return f"Return: {PARAMETER_NAMES.get(parameter, parameter)} {value}"
+
+    def _set(self, parameter, value):
+        if parameter.endswith(".tcpdataoutputenabled"):
+            channel = parameter.split(".")[0]
+            if channel not in self.source.channel_names:
+                return f"Error: Unrecognized channel {channel}, recorded: {', '.join(self.source.channel_names)}"
+            if value.lower() == "true":
+                self.enabled_channels.add(channel)
+            else:
+                self.enabled_channels.discard(channel)
+            return None
+        if parameter == "runmode":
+            if value.lower() not in ("run", "stop"):
+                return f"Error: Invalid value {value} for RunMode"
+            self.parameters["runmode"] = value.capitalize()
+            return None
+        if parameter == "sampleratehertz" and self.running:
+            return "Error: SampleRateHertz cannot be set while running"
+        self.parameters[parameter] = value
+        return None
+
+    def _serve_waveform(self, listener):
+        with listener:
+            while (conn := self._accept(listener)) is not None:
+                with conn:
+                    try:
+                        self._stream(conn)
+                    except OSError:
+                        pass
+
+    def _stream(self, conn):
+        position = 0
+        timestamp = 0
+        started = None
+        while not self._stop_event.is_set():
+            with self._lock:
+                running = self.running and self.enabled_channels
+                channels = sorted(self.enabled_channels)
+            if not running:
+                started = None
+                time.sleep(SEND_INTERVAL)
+                continue
+
+            rate = self.sample_rate * self.speed
+            if started is None:
+                started, sent = time.monotonic(), 0
+            # Send every whole block that is due by now
+            due = int((time.monotonic() - started) * rate) - sent
+            n_blocks = due // FRAMES_PER_BLOCK
+            if n_blocks == 0:
+                time.sleep(SEND_INTERVAL)
+                continue
+            n = n_blocks * FRAMES_PER_BLOCK
+            raw = self.source.read(position, n, self.source.channel_indices(channels))
+            conn.sendall(pack_blocks(timestamp, raw))
+            position = (position + n) % self.source.n_samples
+            timestamp += n
+            sent += n
+            self.blocks_sent += n_blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help=".rhd file, CSV session directory or .emgrec recording")
+    parser.add_argument("--speed", type=float, default=1.0, help="multiple of real time")
+    parser.add_argument("--sample-rate", type=float, default=None, help="advertised sample rate in Hz")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--command-port", type=int, default=5000)
+    parser.add_argument("--waveform-port", type=int, default=5001)
+    args = parser.parse_args()
+
+    source = ReplaySource(args.source)
+    server = ReplayServer(source, args.host, args.command_port, args.waveform_port, args.speed, args.sample_rate)
+    server.start()
+    print(f"Replaying {args.source} ({len(source.channel_names)} channels, {server.sample_rate:g} Hz) "
+          f"at {args.speed:g}x on ports {args.command_port}/{args.waveform_port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
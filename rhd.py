@@ -0,0 +1,358 @@
+"""Reader for Intan RHD2000 (.rhd) recordings, following read_Intan_RHD2000_file.m.
+
+Data blocks are mapped with a structured dtype, so a whole file is decoded in a few
+NumPy operations instead of block-by-block reads.
+"""
+import os
+import struct
+
+import numpy as np
+
+
+RHD_MAGIC = 0xc6912702
+
+AMPLIFIER, AUX_INPUT, SUPPLY_VOLTAGE, BOARD_ADC, BOARD_DIG_IN, BOARD_DIG_OUT = range(6)
+SIGNAL_TYPES = {
+    AMPLIFIER: "amplifier_channels",
+    AUX_INPUT: "aux_input_channels",
+    SUPPLY_VOLTAGE: "supply_voltage_channels",
+    BOARD_ADC: "board_adc_channels",
+    BOARD_DIG_IN: "board_dig_in_channels",
+    BOARD_DIG_OUT: "board_dig_out_channels",
+}
+
+
+class RhdFormatError(Exception):
+    pass
+
+
+class _HeaderReader:
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, fmt):
+        fmt = "<" + fmt
+        values = struct.unpack(fmt, self.f.read(struct.calcsize(fmt)))
+        return values[0] if len(values) == 1 else values
+
+    def qstring(self):
+        length = self.read("I")
+        if length == 0xffffffff:
+            return ""
+        return self.f.read(length).decode("utf-16-le")
+
+
+def read_header(f):
+    """Parse the header of an open .rhd file, leaving f at the first data block."""
+    r = _HeaderReader(f)
+    if r.read("I") != RHD_MAGIC:
+        raise RhdFormatError("Unrecognized file type.")
+
+    header = {}
+    major, minor = r.read("hh")
+    header["version"] = (major, minor)
+    header["num_samples_per_data_block"] = 60 if major == 1 else 128
+
+    sample_rate = r.read("f")
+    dsp_enabled = r.read("h")
+    actual_dsp_cutoff, actual_lower, actual_upper = r.read("fff")
+    desired_dsp_cutoff, desired_lower, desired_upper = r.read("fff")
+    notch_filter_mode = r.read("h")
+    notch_filter_frequency = {1: 50, 2: 60}.get(notch_filter_mode, 0)
+    desired_impedance_freq, actual_impedance_freq = r.read("ff")
+
+    header["sample_rate"] = sample_rate
+    header["frequency_parameters"] = {
+        "amplifier_sample_rate": sample_rate,
+        "aux_input_sample_rate": sample_rate / 4,
+        "supply_voltage_sample_rate": sample_rate / header["num_samples_per_data_block"],
+        "board_adc_sample_rate": sample_rate,
+        "board_dig_in_sample_rate": sample_rate,
+        "desired_dsp_cutoff_frequency": desired_dsp_cutoff,
+        "actual_dsp_cutoff_frequency": actual_dsp_cutoff,
+        "dsp_enabled": dsp_enabled,
+        "desired_lower_bandwidth": desired_lower,
+        "actual_lower_bandwidth": actual_lower,
+        "desired_upper_bandwidth": desired_upper,
+        "actual_upper_bandwidth": actual_upper,
+        "notch_filter_frequency": notch_filter_frequency,
+        "desired_impedance_test_frequency": desired_impedance_freq,
+        "actual_impedance_test_frequency": actual_impedance_freq,
+    }
+    header["notes"] = {"note1": r.qstring(), "note2": r.qstring(), "note3": r.qstring()}
+
+    header["num_temp_sensor_channels"] = 0
+    if (major == 1 and minor >= 1) or major > 1:
+        header["num_temp_sensor_channels"] = r.read("h")
+    header["eval_board_mode"] = 0
+    if (major == 1 and minor >= 3) or major > 1:
+        header["eval_board_mode"] = r.read("h")
+    header["reference_channel"] = r.qstring() if major > 1 else ""
+
+    for key in SIGNAL_TYPES.values():
+        header[key] = []
+    header["spike_triggers"] = []
+
+    number_of_signal_groups = r.read("h")
+    for signal_group in range(1, number_of_signal_groups + 1):
+        group_name = r.qstring()
+        group_prefix = r.qstring()
+        group_enabled, group_num_channels, _ = r.read("hhh")
+        if group_num_channels <= 0 or group_enabled <= 0:
+            continue
+        for _ in range(group_num_channels):
+            channel = {
+                "port_name": group_name,
+                "port_prefix": group_prefix,
+                "port_number": signal_group,
+                "native_channel_name": r.qstring(),
+                "custom_channel_name": r.qstring(),
+            }
+            channel["native_order"], channel["custom_order"] = r.read("hh")
+            signal_type, channel_enabled = r.read("hh")
+            channel["chip_channel"], channel["board_stream"] = r.read("hh")
+            trigger = dict(zip(
+                ("voltage_trigger_mode", "voltage_threshold", "digital_trigger_channel", "digital_edge_polarity"),
+                r.read("hhhh"),
+            ))
+            channel["electrode_impedance_magnitude"], channel["electrode_impedance_phase"] = r.read("ff")
+            if not channel_enabled:
+                continue
+            if signal_type not in SIGNAL_TYPES:
+                raise RhdFormatError("Unknown channel type")
+            header[SIGNAL_TYPES[signal_type]].append(channel)
+            if signal_type == AMPLIFIER:
+                header["spike_triggers"].append(trigger)
+
+    header["header_size"] = f.tell()
+    return header
+
+
+def block_dtype(header):
+    """Structured dtype of one data block; each channel's samples are contiguous."""
+    n = header["num_samples_per_data_block"]
+    major, minor = header["version"]
+    timestamp = "<i4" if (major == 1 and minor >= 2) or major > 1 else "<u4"
+
+    fields = [("timestamps", timestamp, (n,))]
+    counts = {key: len(header[key]) for key in SIGNAL_TYPES.values()}
+    if counts["amplifier_channels"]:
+        fields.append(("amplifier", "<u2", (counts["amplifier_channels"], n)))
+    if counts["aux_input_channels"]:
+        fields.append(("aux_input", "<u2", (counts["aux_input_channels"], n // 4)))
+    if counts["supply_voltage_channels"]:
+        fields.append(("supply_voltage", "<u2", (counts["supply_voltage_channels"],)))
+    if header["num_temp_sensor_channels"]:
+        fields.append(("temp_sensor", "<i2", (header["num_temp_sensor_channels"],)))
+    if counts["board_adc_channels"]:
+        fields.append(("board_adc", "<u2", (counts["board_adc_channels"], n)))
+    if counts["board_dig_in_channels"]:
+        fields.append(("board_dig_in", "<u2", (n,)))
+    if counts["board_dig_out_channels"]:
+        fields.append(("board_dig_out", "<u2", (n,)))
+    return np.dtype(fields)
+
+
+def map_blocks(path, header=None):
+    """Memory-map the data blocks of an .rhd file. Returns (header, blocks)."""
+    if header is None:
+        with open(path, "rb") as f:
+            header = read_header(f)
+    dtype = block_dtype(header)
+    data_bytes = os.path.getsize(path) - header["header_size"]
+    if data_bytes % dtype.itemsize:
+        raise RhdFormatError(
+            f"{data_bytes} bytes of data is not a whole number of {dtype.itemsize} byte blocks"
+        )
+    n_blocks = data_bytes // dtype.itemsize
+    if n_blocks == 0:
+        return header, np.empty(0, dtype=dtype)
+    blocks = np.memmap(path, dtype=dtype, mode="r", offset=header["header_size"], shape=(n_blocks,))
+    return header, blocks
+
+
+def _channels_by_samples(field):
+    # (blocks, channels, samples per block) -> (channels, blocks * samples per block)
+    return field.transpose(1, 0, 2).reshape(field.shape[1], -1)
+
+
+def amplifier_to_microvolts(raw, dtype=np.float32):
+    return (raw.astype(dtype) - 32768) * dtype(0.195)
+
+
+def board_adc_to_volts(raw, eval_board_mode, dtype=np.float32):
+    if eval_board_mode == 1:
+        return (raw.astype(dtype) - 32768) * dtype(152.59e-6)
+    if eval_board_mode == 13:  # Intan Recording Controller
+        return (raw.astype(dtype) - 32768) * dtype(312.5e-6)
+    return raw.astype(dtype) * dtype(50.354e-6)
+
+
+def _dig_bits(raw, channels):
+    words = raw.reshape(-1)
+    return np.stack([(words >> ch["native_order"]) & 1 for ch in channels]).astype(np.uint8)
+
+
+def notch_filter(data, sample_rate, notch_frequency, bandwidth=10):
+    """Second order IIR notch along the last axis, as notch_filter in the MATLAB reader.
+
+    Uses scipy.signal.lfilter when scipy is installed, otherwise a (much slower) loop.
+    """
+    tstep = 1 / sample_rate
+    fc = notch_frequency * tstep
+    d = np.exp(-2 * np.pi * (bandwidth / 2) * tstep)
+    b = (1 + d * d) * np.cos(2 * np.pi * fc)
+    a = (1 + d * d) / 2
+    num = np.array([a, -2 * a * np.cos(2 * np.pi * fc), a])
+    den = np.array([1, -b, d * d])
+
+    data = np.asarray(data)
+    out = np.array(data, dtype=np.float64)
+    if data.shape[-1] <= 2:
+        return out.astype(data.dtype)
+    # The first two outputs are the inputs, filtering starts from there
+    try:
+        from scipy.signal import lfilter, lfiltic
+    except ImportError:
+        x = data.astype(np.float64)
+        for i in range(2, x.shape[-1]):
+            out[..., i] = (num[2] * x[..., i - 2] + num[1] * x[..., i - 1] + num[0] * x[..., i]
+                           - den[2] * out[..., i - 2] - den[1] * out[..., i - 1])
+    else:
+        flat_in = data.reshape(-1, data.shape[-1])
+        flat_out = out.reshape(-1, data.shape[-1])
+        for x, y in zip(flat_in, flat_out):
+            zi = lfiltic(num, den, y=[x[1], x[0]], x=[x[1], x[0]])
+            y[2:], _ = lfilter(num, den, x[2:], zi=zi)
+    return out.astype(data.dtype)
+
+
+def read_rhd(path, dtype=np.float32, notch=True):
+    """Load an .rhd recording with the same variable names as read_Intan_RHD2000_file.m.
+
+    Amplifier data is returned in microvolts as a channels x samples array. As in the
+    MATLAB reader, the software notch filter from the header is applied unless notch
+    is False.
+    """
+    header, blocks = map_blocks(path)
+    sample_rate = header["sample_rate"]
+    result = {"header": header, "sample_rate": sample_rate}
+
+    t = blocks["timestamps"].reshape(-1)
+    result["timestamps"] = np.asarray(t)
+    result["t_amplifier"] = t / sample_rate
+    result["num_gaps"] = int(np.count_nonzero(np.diff(t) != 1))
+
+    names = blocks.dtype.names
+    if "amplifier" in names:
+        result["amplifier_data"] = amplifier_to_microvolts(_channels_by_samples(blocks["amplifier"]), dtype)
+        notch_frequency = header["frequency_parameters"]["notch_filter_frequency"]
+        if notch and notch_frequency > 0:
+            result["amplifier_data"] = notch_filter(result["amplifier_data"], sample_rate, notch_frequency)
+    if "aux_input" in names:
+        result["aux_input_data"] = _channels_by_samples(blocks["aux_input"]).astype(dtype) * dtype(37.4e-6)
+        result["t_aux_input"] = result["t_amplifier"][::4]
+    if "supply_voltage" in names:
+        result["supply_voltage_data"] = blocks["supply_voltage"].T.astype(dtype) * dtype(74.8e-6)
+        result["t_supply_voltage"] = result["t_amplifier"][::header["num_samples_per_data_block"]]
+    if "temp_sensor" in names:
+        result["temp_sensor_data"] = blocks["temp_sensor"].T.astype(dtype) / 100
+    if "board_adc" in names:
+        result["board_adc_data"] = board_adc_to_volts(
+            _channels_by_samples(blocks["board_adc"]), header["eval_board_mode"], dtype
+        )
+    if "board_dig_in" in names:
+        result["board_dig_in_data"] = _dig_bits(blocks["board_dig_in"], header["board_dig_in_channels"])
+    if "board_dig_out" in names:
+        result["board_dig_out_data"] = _dig_bits(blocks["board_dig_out"], header["board_dig_out_channels"])
+    return result
+
+
+class RhdRecording:
+    """Lazily opened .rhd recording.
+
+    Only the header is parsed on construction. Data blocks stay memory-mapped and are
+    located arithmetically from the header size and block size, so read() touches just
+    the blocks covering the requested time range and channels.
+
+    Times are in seconds on the same clock as t_amplifier (timestamp / sample rate).
+    Block positions assume the file has no timestamp gaps, see count_gaps().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header, self.blocks = map_blocks(path)
+        self.sample_rate = self.header["sample_rate"]
+        self.samples_per_block = self.header["num_samples_per_data_block"]
+        self.block_size = self.blocks.dtype.itemsize
+        self.n_blocks = len(self.blocks)
+        self.n_samples = self.n_blocks * self.samples_per_block
+        self.channel_names = [ch["native_channel_name"] for ch in self.header["amplifier_channels"]]
+        self.first_timestamp = int(self.blocks["timestamps"][0, 0]) if self.n_blocks else 0
+
+    @property
+    def start_time(self):
+        return self.first_timestamp / self.sample_rate
+
+    @property
+    def duration(self):
+        return self.n_samples / self.sample_rate
+
+    @property
+    def stop_time(self):
+        return self.start_time + self.duration
+
+    @property
+    def block_offsets(self):
+        return self.header["header_size"] + np.arange(self.n_blocks) * self.block_size
+
+    def count_gaps(self):
+        """Number of timestamp discontinuities; reads every block's timestamps."""
+        return int(np.count_nonzero(np.diff(self.blocks["timestamps"].reshape(-1)) != 1))
+
+    def channel_indices(self, channels=None):
+        if channels is None:
+            return list(range(len(self.channel_names)))
+        return [self.channel_names.index(ch) if isinstance(ch, str) else ch for ch in channels]
+
+    def sample_index(self, t):
+        i = int(round((t - self.start_time) * self.sample_rate))
+        return min(max(i, 0), self.n_samples)
+
+    def read_raw(self, start=0, stop=None, channels=None):
+        """Unscaled amplifier samples [start, stop) as (timestamps, channels x samples uint16)."""
+        stop = self.n_samples if stop is None else min(stop, self.n_samples)
+        start = min(max(start, 0), stop)
+        first_block = start // self.samples_per_block
+        last_block = -(-stop // self.samples_per_block)
+        blocks = self.blocks[first_block:last_block]
+        skip = start - first_block * self.samples_per_block
+
+        indices = self.channel_indices(channels)
+        raw = _channels_by_samples(blocks["amplifier"][:, indices, :])[:, skip:skip + stop - start]
+        timestamps = blocks["timestamps"].reshape(-1)[skip:skip + stop - start]
+        return timestamps, raw
+
+    def read_samples(self, start=0, stop=None, channels=None, notch=True, dtype=np.float32):
+        """Amplifier samples [start, stop) as (t_amplifier, channels x samples microvolts)."""
+        timestamps, raw = self.read_raw(start, stop, channels)
+        data = amplifier_to_microvolts(raw, dtype)
+        t = timestamps / self.sample_rate
+
+        notch_frequency = self.header["frequency_parameters"]["notch_filter_frequency"]
+        if notch and notch_frequency > 0:
+            # The filter restarts at `start`, so the first few ms differ from a whole-file read
+            data = notch_filter(data, self.sample_rate, notch_frequency)
+        return t, data
+
+    def read(self, start=None, stop=None, channels=None, notch=True, dtype=np.float32):
+        """Amplifier data between start and stop seconds, channels given by index or name."""
+        start = 0 if start is None else self.sample_index(start)
+        stop = None if stop is None else self.sample_index(stop)
+        return self.read_samples(start, stop, channels, notch, dtype)
+
+    def iter_chunks(self, seconds=10, channels=None, notch=False, dtype=np.float32):
+        """Yield (t_amplifier, data) chunks covering the whole file with bounded memory."""
+        chunk = max(int(seconds * self.sample_rate), 1)
+        for start in range(0, self.n_samples, chunk):
+            yield self.read_samples(start, start + chunk, channels, notch, dtype)
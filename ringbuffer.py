@@ -0,0 +1,132 @@
+import time
+
+import numpy as np
+
+
+class SampleRingBuffer:
+    """Fixed-capacity ring of decoded samples with one writer and any number of readers.
+
+    Storage is mirrored: every sample is written at i and i + capacity, so the most
+    recent n <= capacity samples are always one contiguous slice and latest() can hand
+    out views without copying.
+
+    The writer publishes the end of a block in `writing` before copying it in and only
+    then advances `written`, so a reader that snapshots `written` never sees a half
+    written block, and a reader that checks `writing` after copying knows which slots a
+    write in progress may have overwritten. Readers keep their own cursor (see
+    RingReader) and therefore consume at their own rate.
+    """
+
+    def __init__(self, n_channels=2, capacity=2**18, sample_rate=None):
+        self.n_channels = n_channels
+        self.capacity = capacity
+        self.sample_rate = sample_rate
+        self.timestamps = np.zeros(2 * capacity, dtype=np.int32)
+        self.samples = np.zeros((n_channels, 2 * capacity), dtype=np.float32)
+        # time.perf_counter() when each sample was received, for latency tracing
+        self.arrivals = np.zeros(2 * capacity)
+        # Total number of samples ever written, only changed by the writer
+        self.written = 0
+        # written once the block being copied in is done, set before its slots change
+        self.writing = 0
+
+    @classmethod
+    def for_duration(cls, seconds, sample_rate, n_channels=2):
+        return cls(n_channels, int(np.ceil(seconds * sample_rate)), sample_rate)
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def write(self, timestamps, samples, arrival=None):
+        arrival = time.perf_counter() if arrival is None else arrival
+        n = len(timestamps)
+        if n > self.capacity:
+            timestamps = timestamps[-self.capacity:]
+            samples = samples[:, -self.capacity:]
+            skipped, n = n - self.capacity, self.capacity
+        else:
+            skipped = 0
+
+        self.writing = self.written + skipped + n
+        start = (self.written + skipped) % self.capacity
+        first = min(n, self.capacity - start)
+        for offset in (start, start + self.capacity):
+            self.timestamps[offset:offset + first] = timestamps[:first]
+            self.samples[:, offset:offset + first] = samples[:, :first]
+            self.arrivals[offset:offset + first] = arrival
+        if first < n:
+            # Wrapped: the tail goes to the start of both halves
+            for offset in (0, self.capacity):
+                self.timestamps[offset:offset + n - first] = timestamps[first:]
+                self.samples[:, offset:offset + n - first] = samples[:, first:]
+                self.arrivals[offset:offset + n - first] = arrival
+        self.written += skipped + n
+
+    def _span(self, start, stop):
+        offset = start % self.capacity
+        return slice(offset, offset + stop - start)
+
+    def latest(self, n=None):
+        """Views of the most recent n samples (all buffered samples by default).
+
+        The views alias the ring, they are only stable until the next write.
+        """
+        written = self.written
+        n = len(self) if n is None else min(n, len(self))
+        span = self._span(written - n, written)
+        return self.timestamps[span], self.samples[:, span]
+
+    def latest_seconds(self, seconds):
+        return self.latest(int(seconds * self.sample_rate))
+
+    def read(self, cursor, max_samples=None):
+        """Copy out the samples written since cursor.
+
+        Returns (timestamps, samples, cursor, dropped) where cursor is the position to
+        pass to the next call and dropped counts samples overwritten before they were read.
+        """
+        written = self.written
+        start = max(cursor, written - self.capacity)
+        if max_samples is not None:
+            written = min(written, start + max_samples)
+        span = self._span(start, written)
+        timestamps = self.timestamps[span].copy()
+        samples = self.samples[:, span].copy()
+
+        # The writer may have lapped us while copying, discard anything it overwrote,
+        # including the slots of a write still in progress
+        overwritten = self.writing - self.capacity - start
+        if overwritten > 0:
+            timestamps = timestamps[overwritten:]
+            samples = samples[:, overwritten:]
+            start = min(start + overwritten, written)
+        return timestamps, samples, written, start - cursor
+
+    def arrival(self, index):
+        """When sample number index (counted over all writes) was received."""
+        return self.arrivals[index % self.capacity]
+
+    def reader(self, from_start=False):
+        return RingReader(self, 0 if from_start else self.written)
+
+
+class RingReader:
+    """Consumer handle on a SampleRingBuffer with its own read position."""
+
+    def __init__(self, ring, cursor=0):
+        self.ring = ring
+        self.cursor = cursor
+        self.dropped = 0
+        # Arrival time of the newest sample returned by read()
+        self.last_arrival = None
+
+    @property
+    def available(self):
+        return self.ring.written - self.cursor
+
+    def read(self, max_samples=None):
+        timestamps, samples, self.cursor, dropped = self.ring.read(self.cursor, max_samples)
+        self.dropped += dropped
+        if len(timestamps):
+            self.last_arrival = self.ring.arrival(self.cursor - 1)
+        return timestamps, samples
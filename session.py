@@ -0,0 +1,268 @@
+"""Binary cache for session directories exported by Intan RHX as CSV.
+
+import_session() converts each CSV stream of a session directory to an .npy file and
+writes metadata.json with the channel tables and sample rate. load_session() reuses the
+cache as long as the source files are unchanged and memory-maps the arrays, so opening
+a session again does not parse any text.
+
+label_session() adds a label for every sample from the recording protocol (see
+protocol.py), with the start and stop index of every phase, so the samples of a class
+are sliced directly:
+
+    python session.py data/botharms_230301_160059 --protocol data/raw/botharms_230301_155959/botharms.txt --offset 60
+
+    session = load_session("data/botharms_230301_160059")
+    for t, data in session.iter_segments(protocol.BOTH):
+        ...
+"""
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+
+from protocol import LABEL_NAMES, UNLABELLED, find_protocol, protocol_labels, read_protocol
+
+
+CACHE_DIR = "cache"
+METADATA_FILE = "metadata.json"
+LABELS_FILE = "labels.json"
+CACHE_VERSION = 1
+
+# stream name -> dtype stored in the cache
+STREAMS = {
+    "amplifier_data": np.float32,
+    "t_amplifier": np.float64,
+    "aux_input_data": np.float32,
+    "t_aux_input": np.float64,
+}
+CHANNEL_TABLES = ("amplifier_channels", "aux_input_channels")
+CHANNEL_FIELDS = (
+    "native_channel_name", "custom_channel_name", "native_order", "custom_order",
+    "board_stream", "chip_channel", "port_name", "port_prefix", "port_number",
+    "electrode_impedance_magnitude", "electrode_impedance_phase",
+)
+
+
+def read_channel_table(path):
+    channels = []
+    with open(path, newline="") as f:
+        for row in csv.reader(f, quotechar="'"):
+            if not row:
+                continue
+            channel = dict(zip(CHANNEL_FIELDS, row))
+            for key in ("native_order", "custom_order", "board_stream", "chip_channel", "port_number"):
+                channel[key] = int(channel[key])
+            for key in ("electrode_impedance_magnitude", "electrode_impedance_phase"):
+                channel[key] = float(channel[key])
+            channels.append(channel)
+    return channels
+
+
+def _source_files(session_dir):
+    names = [f"{name}.csv" for name in (*STREAMS, *CHANNEL_TABLES)]
+    return [name for name in names if os.path.exists(os.path.join(session_dir, name))]
+
+
+def _fingerprint(session_dir):
+    fingerprint = {}
+    for name in _source_files(session_dir):
+        st = os.stat(os.path.join(session_dir, name))
+        fingerprint[name] = [st.st_size, st.st_mtime_ns]
+    return fingerprint
+
+
+def cache_is_valid(session_dir):
+    try:
+        with open(os.path.join(session_dir, CACHE_DIR, METADATA_FILE)) as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return metadata.get("version") == CACHE_VERSION and metadata.get("sources") == _fingerprint(session_dir)
+
+
+def import_session(session_dir, force=False):
+    """Convert the CSV files of session_dir into its cache directory, if needed."""
+    cache_dir = os.path.join(session_dir, CACHE_DIR)
+    if not force and cache_is_valid(session_dir):
+        return cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+
+    metadata = {"version": CACHE_VERSION, "sources": _fingerprint(session_dir), "streams": {}}
+    for name in CHANNEL_TABLES:
+        path = os.path.join(session_dir, f"{name}.csv")
+        metadata[name] = read_channel_table(path) if os.path.exists(path) else []
+
+    for name, dtype in STREAMS.items():
+        path = os.path.join(session_dir, f"{name}.csv")
+        if not os.path.exists(path):
+            continue
+        array = np.loadtxt(path, delimiter=",", dtype=np.float64, ndmin=2).astype(dtype)
+        if name.startswith("t_"):
+            array = array.reshape(-1)
+        np.save(os.path.join(cache_dir, f"{name}.npy"), array)
+        metadata["streams"][name] = {"shape": list(array.shape), "dtype": np.dtype(dtype).str}
+
+    if "t_amplifier" in metadata["streams"]:
+        t = np.load(os.path.join(cache_dir, "t_amplifier.npy"), mmap_mode="r")
+        metadata["sample_rate"] = float(round(1 / np.median(np.diff(t[:1000])))) if len(t) > 1 else None
+
+    # Written last, so an interrupted import is never mistaken for a valid cache
+    with open(os.path.join(cache_dir, METADATA_FILE), "w") as f:
+        json.dump(metadata, f, indent=1)
+    return cache_dir
+
+
+def _file_fingerprint(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def label_segments(labels):
+    """{label name: [[start, stop], ...]} sample ranges of every labelled phase."""
+    segments = {name: [] for name in LABEL_NAMES}
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(labels)) + 1, [len(labels)]])
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        if stop > start and labels[start] != UNLABELLED:
+            segments[LABEL_NAMES[labels[start]]].append([int(start), int(stop)])
+    return segments
+
+
+def label_session(session_dir, protocol_path, offset=0.0, active=None):
+    """Label every sample of session_dir from a protocol file and cache the labels.
+
+    offset is the t_amplifier time at which the protocol started, active the label of a
+    phase that flexes without naming an arm (see protocol.read_protocol). Returns the
+    label metadata written to labels.json.
+    """
+    cache_dir = import_session(session_dir)
+    with open(os.path.join(cache_dir, METADATA_FILE)) as f:
+        metadata = json.load(f)
+    if "t_amplifier" not in metadata["streams"]:
+        raise ValueError(f"{session_dir} has no t_amplifier to label")
+    t = np.load(os.path.join(cache_dir, "t_amplifier.npy"), mmap_mode="r")
+    phases = read_protocol(protocol_path, active)
+    labels = protocol_labels(t, phases, offset)
+    np.save(os.path.join(cache_dir, "labels.npy"), labels)
+
+    info = {
+        "sources": metadata["sources"],
+        "protocol": os.path.abspath(protocol_path),
+        "protocol_source": _file_fingerprint(protocol_path),
+        "offset": offset,
+        "active": active,
+        "phases": phases,
+        "segments": label_segments(labels),
+    }
+    with open(os.path.join(cache_dir, LABELS_FILE), "w") as f:
+        json.dump(info, f, indent=1)
+    return info
+
+
+def _load_labels(session_dir, cache_dir, metadata):
+    try:
+        with open(os.path.join(cache_dir, LABELS_FILE)) as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    protocol = info["protocol"]
+    protocol_changed = os.path.exists(protocol) and _file_fingerprint(protocol) != info["protocol_source"]
+    if info["sources"] != metadata["sources"] or protocol_changed:
+        # Relabel from the same protocol, keeping labels we can't recompute would misalign them
+        if not os.path.exists(protocol):
+            return None
+        info = label_session(session_dir, protocol, info["offset"], info["active"])
+    return info
+
+
+class Session:
+    """Memory-mapped view of a cached CSV session."""
+
+    def __init__(self, session_dir, metadata, arrays, label_info=None):
+        self.session_dir = session_dir
+        self.metadata = metadata
+        self.arrays = arrays
+        self.label_info = label_info
+        self._segments = {}
+        self.sample_rate = metadata.get("sample_rate")
+        self.amplifier_channels = metadata["amplifier_channels"]
+        self.aux_input_channels = metadata["aux_input_channels"]
+        self.channel_names = [ch["native_channel_name"] for ch in self.amplifier_channels]
+
+    @property
+    def amplifier_data(self):
+        return self.arrays["amplifier_data"]
+
+    @property
+    def t_amplifier(self):
+        return self.arrays["t_amplifier"]
+
+    @property
+    def labels(self):
+        """Label of every sample (protocol.RELAX ... BOTH, UNLABELLED), None if not labelled."""
+        return self.arrays.get("labels")
+
+    def read(self, start=None, stop=None, channels=None):
+        """Amplifier data between start and stop seconds (t_amplifier clock)."""
+        t = self.t_amplifier
+        left = 0 if start is None else int(np.searchsorted(t, start))
+        right = len(t) if stop is None else int(np.searchsorted(t, stop))
+        return t[left:right], self._channels(self.amplifier_data[:, left:right], channels)
+
+    def _channels(self, data, channels):
+        if channels is not None:
+            indices = [self.channel_names.index(ch) if isinstance(ch, str) else ch for ch in channels]
+            data = data[indices]
+        return data
+
+    def segments(self, label):
+        """(k, 2) start and stop sample indices of the phases with label (number or name)."""
+        if self.label_info is None:
+            raise ValueError(f"{self.session_dir} is not labelled, see label_session()")
+        name = label if isinstance(label, str) else LABEL_NAMES[label]
+        if name not in self._segments:
+            self._segments[name] = np.array(self.label_info["segments"][name], dtype=np.int64).reshape(-1, 2)
+        return self._segments[name]
+
+    def iter_segments(self, label, channels=None):
+        """Yield (t_amplifier, data) views of every phase with label."""
+        for start, stop in self.segments(label):
+            yield self.t_amplifier[start:stop], self._channels(self.amplifier_data[:, start:stop], channels)
+
+
+def load_session(session_dir, mmap_mode="r"):
+    cache_dir = import_session(session_dir)
+    with open(os.path.join(cache_dir, METADATA_FILE)) as f:
+        metadata = json.load(f)
+    arrays = {
+        name: np.load(os.path.join(cache_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+        for name in metadata["streams"]
+    }
+    label_info = _load_labels(session_dir, cache_dir, metadata)
+    if label_info is not None:
+        arrays["labels"] = np.load(os.path.join(cache_dir, "labels.npy"), mmap_mode=mmap_mode)
+    return Session(session_dir, metadata, arrays, label_info)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a CSV session and label it from its protocol.")
+    parser.add_argument("session_dir")
+    parser.add_argument("--protocol", help="protocol text file (default: the .txt in the session directory)")
+    parser.add_argument("--offset", type=float, default=0.0, help="t_amplifier time at which the protocol started")
+    args = parser.parse_args()
+
+    protocol = args.protocol or find_protocol(args.session_dir)
+    if protocol is None:
+        parser.error(f"No protocol found in {args.session_dir}, pass --protocol")
+    label_session(args.session_dir, protocol, args.offset)
+    session = load_session(args.session_dir)
+    for label, name in enumerate(LABEL_NAMES):
+        segments = session.segments(label)
+        seconds = (segments[:, 1] - segments[:, 0]).sum() / session.sample_rate
+        print(f"{name:<6} {len(segments)} phases, {seconds:.2f} s")
+    print(f"unlabelled {np.count_nonzero(session.labels == UNLABELLED) / session.sample_rate:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""Parallel sweep of classifier settings over labelled sessions.
+
+Every combination of bucket count, moving average window, thresholds and flip is scored
+against a label for every sample of each recording, reporting per-class accuracy and
+switching latency:
+
+    python sweep.py data/raw/botharms_230301_155959/botharms_230301_160059.rhd --offset 60 \\
+        --buckets 300 600 --ma-window 3 10 20 --threshold1 30 40 50 60 --threshold-diff 25 35 45
+    python sweep.py data/botharms_230301_160059 --protocol data/raw/botharms_230301_155959/botharms.txt --offset 60
+
+Labels come from the recording's protocol (see protocol.py): the .txt next to it or
+--protocol, with --offset the time on the recording's clock at which the protocol
+started. Session directories labelled with session.label_session() use their cached
+labels unless --protocol is given. --labels instead takes .npy arrays with one entry per
+sample, in the classes of SignalProcessor controls (0 relax, 1 right arm, 2 left arm,
+3 both arms) or UNLABELLED (-1) for samples that are not scored.
+
+Controls follow SignalProcessor.update_energies: control = 2 * (moving average of
+channel 0 > threshold1) + (channel 1 > threshold_diff), on the mean absolute value of
+each bucket, so thresholds carry over to the live controller when the bucket length
+matches its feature window (CONTROL_INTERVAL). A bucket is labelled with the class
+most of its samples have.
+
+The per-bucket energies of each recording and bucket count are computed once, saved in
+the recording's cache directory and memory-mapped by every worker, so no configuration
+touches the raw samples.
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from protocol import LABEL_NAMES, UNLABELLED, find_protocol, protocol_labels, read_protocol
+from recorder import read_recording, RECORDING_EXTENSION
+from replay_server import arm_channels
+from rhd import RhdRecording
+from session import CACHE_DIR, load_session
+
+
+BUCKETS = (600,)
+MA_WINDOWS = (3, 20)
+THRESHOLDS1 = (50,)
+THRESHOLDS_DIFF = (35,)
+
+
+def load_times(path):
+    """Sample times of a recording in seconds, without reading the samples."""
+    if path.endswith(RECORDING_EXTENSION):
+        recording = read_recording(path)
+        return recording["timestamps"] / recording["metadata"]["sample_rate"]
+    if os.path.isdir(path):
+        return load_session(path).t_amplifier
+    recording = RhdRecording(path)
+    return recording.blocks["timestamps"].reshape(-1) / recording.sample_rate
+
+
+def load_samples(path, channels=None):
+    """2 x n microvolts of the given channels, left arm first (default: the first two)."""
+    if path.endswith(RECORDING_EXTENSION):
+        recording = read_recording(path)
+        names = [f"a-{i:03}" for i in range(recording["metadata"]["n_channels"])]
+        data = recording["samples"]
+    elif os.path.isdir(path):
+        session = load_session(path)
+        names = [name.lower() for name in session.channel_names]
+        data = session.amplifier_data
+    else:
+        recording = RhdRecording(path)
+        names = [name.lower() for name in recording.channel_names]
+        data = None
+    indices = arm_channels(path, names, channels)
+    if data is None:
+        return recording.read(channels=indices, notch=False)[1]
+    return np.asarray(data[indices])
+
+
+def load_labels(path, labels_path=None, protocol=None, offset=0.0, t=None):
+    """Label of every sample of path.
+
+    From a .npy array if labels_path is given, else a labelled session's cached labels,
+    else the protocol file (by default the one next to the recording).
+    """
+    t = load_times(path) if t is None else t
+    if labels_path is not None:
+        labels = np.load(labels_path, mmap_mode="r")
+        if labels.shape != (len(t),):
+            raise ValueError(f"{labels_path} has {labels.shape} labels, {path} has {len(t)} samples")
+        return np.asarray(labels, dtype=np.int8)
+    if protocol is None and os.path.isdir(path):
+        session = load_session(path)
+        if session.labels is not None:
+            return np.asarray(session.labels)
+    protocol = protocol or find_protocol(path)
+    if protocol is None:
+        raise ValueError(f"No protocol found for {path}, pass --protocol or --labels, or label the session")
+    return protocol_labels(t, read_protocol(protocol), offset)
+
+
+def _modified(path):
+    if not os.path.isdir(path):
+        return os.stat(path).st_mtime_ns
+    return max(entry.stat().st_mtime_ns for entry in os.scandir(path) if entry.is_file())
+
+
+def bucket_bounds(n, n_buckets):
+    """[left, right) sample indices of n_buckets equal slices, as plot_emg.integrate uses."""
+    left = (np.arange(n_buckets) / n_buckets * n).astype(np.intp)
+    return left, np.append(left[1:], n)
+
+
+def bucket_energies(samples, n_buckets):
+    """Mean absolute value of each channel in every bucket, channels x n_buckets."""
+    left, right = bucket_bounds(samples.shape[-1], n_buckets)
+    totals = np.zeros((samples.shape[0], samples.shape[-1] + 1))
+    np.cumsum(np.abs(samples, dtype=np.float64), axis=-1, out=totals[:, 1:])
+    return (totals[:, right] - totals[:, left]) / np.maximum(right - left, 1)
+
+
+def energy_cache_path(path, n_buckets, channels=None):
+    if os.path.isdir(path):
+        directory, stem = path, "session"
+    else:
+        directory, stem = os.path.dirname(path), os.path.basename(path)
+    suffix = "-".join(name.lower() for name in channels) if channels else "default"
+    return os.path.join(directory, CACHE_DIR, f"{stem}.mav{n_buckets}.{suffix}.npy")
+
+
+def cached_energies(path, n_buckets, channels=None):
+    """Path of the .npy holding the bucket energies of path, computed if missing or stale."""
+    cache = energy_cache_path(path, n_buckets, channels)
+    if os.path.exists(cache) and os.stat(cache).st_mtime_ns >= _modified(path):
+        return cache
+    energies = bucket_energies(load_samples(path, channels), n_buckets)
+    os.makedirs(os.path.dirname(cache), exist_ok=True)
+    # Renamed into place, so a concurrent reader never maps a partial file
+    partial = f"{cache}.{os.getpid()}.npy"
+    np.save(partial, energies)
+    os.replace(partial, cache)
+    return cache
+
+
+def bucket_labels(labels, n_buckets):
+    """Label most samples of each bucket have, UNLABELLED included."""
+    classes = np.arange(UNLABELLED, len(LABEL_NAMES))
+    left, right = bucket_bounds(len(labels), n_buckets)
+    counts = np.zeros((len(classes), len(labels) + 1), dtype=np.int64)
+    np.cumsum(labels[None, :] == classes[:, None], axis=1, out=counts[:, 1:])
+    return classes[np.argmax(counts[:, right] - counts[:, left], axis=0)]
+
+
+def trailing_mean(a, n):
+    """Sum of the last n values over n, from the first value on, like SignalProcessor's running sums."""
+    sums = np.cumsum(a, dtype=np.float64)
+    sums[n:] = sums[n:] - sums[:-n].copy()
+    return sums / n
+
+
+def classify(energies, threshold1, threshold_diff, ma_window, flip=False):
+    """Controls of every bucket, SignalProcessor.update_energies over the whole array."""
+    int1, int2 = (energies[1], energies[0]) if flip else (energies[0], energies[1])
+    c1 = trailing_mean(int1, ma_window) > threshold1
+    c2 = int2 > threshold_diff
+    return c1.astype(np.int8) * 2 + c2
+
+
+def score(controls, labels, bucket_seconds):
+    """Per-class accuracy and switching latency of controls against bucket labels.
+
+    Switching latency is the time from the start of a labelled phase to the end of the
+    first bucket in it classified correctly; phases never classified correctly count as
+    missed switches.
+    """
+    labelled = labels != UNLABELLED
+    correct = (controls == labels) & labelled
+    result = {"accuracy": float(correct.sum() / max(labelled.sum(), 1))}
+    recalls = []
+    for label, name in enumerate(LABEL_NAMES):
+        n = np.count_nonzero(labels == label)
+        result[f"acc_{name}"] = float(np.count_nonzero(correct & (labels == label)) / n) if n else None
+        if n:
+            recalls.append(result[f"acc_{name}"])
+    result["balanced_accuracy"] = float(np.mean(recalls)) if recalls else 0.0
+
+    starts = np.flatnonzero(np.diff(labels) != 0) + 1
+    ends = np.append(starts[1:], len(labels))
+    latencies, missed = [], 0
+    for start, end in zip(starts, ends):
+        if labels[start] == UNLABELLED:
+            continue
+        hits = np.flatnonzero(correct[start:end])
+        if len(hits):
+            latencies.append((hits[0] + 1) * bucket_seconds)
+        else:
+            missed += 1
+    result["switches"] = len(latencies) + missed
+    result["switch_latency_ms"] = float(np.mean(latencies) * 1e3) if latencies else None
+    result["missed_switches"] = missed
+    return result
+
+
+def evaluate_configs(energies_path, labels, bucket_seconds, configs):
+    """Score a chunk of configurations on one memory-mapped energy array."""
+    energies = np.load(energies_path, mmap_mode="r")
+    return [{**config, **score(classify(energies, **config), labels, bucket_seconds)} for config in configs]
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def format_result(result):
+    classes = " ".join(f"{name}={'-' if result[f'acc_{name}'] is None else format(result[f'acc_{name}'], '.2f')}"
+                       for name in LABEL_NAMES)
+    latency = "-" if result["switch_latency_ms"] is None else f"{result['switch_latency_ms']:.0f} ms"
+    return (f"{os.path.basename(os.path.normpath(result['recording'])):<30} buckets={result['n_buckets']:<5}"
+            f" ma={result['ma_window']:<3} t1={result['threshold1']:<6g} td={result['threshold_diff']:<6g}"
+            f" flip={int(result['flip'])}  balanced={result['balanced_accuracy']:.3f} {classes}"
+            f"  switch={latency} missed={result['missed_switches']}/{result['switches']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recordings", nargs="+")
+    parser.add_argument("--protocol", help="protocol text file (default: the .txt next to each recording)")
+    parser.add_argument("--offset", type=float, default=0.0, help="recording time at which the protocol started")
+    parser.add_argument("--labels", nargs="+", default=None, help="per-sample label .npy, one per recording")
+    parser.add_argument("--channels", nargs=2, default=None, help="left arm channel first (default: the first two)")
+    parser.add_argument("--buckets", type=int, nargs="+", default=BUCKETS)
+    parser.add_argument("--ma-window", type=int, nargs="+", default=MA_WINDOWS, help="moving average in buckets")
+    parser.add_argument("--threshold1", type=float, nargs="+", default=THRESHOLDS1)
+    parser.add_argument("--threshold-diff", type=float, nargs="+", default=THRESHOLDS_DIFF)
+    parser.add_argument("--flip", type=int, nargs="+", choices=(0, 1), default=[0, 1])
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--top", type=int, default=10, help="best configurations to print per recording")
+    parser.add_argument("--json", help="write every result to this JSON file")
+    args = parser.parse_args()
+    channels = tuple(args.channels) if args.channels else None
+    if args.labels is not None and len(args.labels) != len(args.recordings):
+        parser.error("Pass one --labels file per recording")
+
+    configs = [{"threshold1": t1, "threshold_diff": td, "ma_window": ma, "flip": bool(flip)}
+               for t1, td, ma, flip in itertools.product(args.threshold1, args.threshold_diff, args.ma_window, args.flip)]
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(args.workers) as pool:
+        # Energies first, one job per recording and bucket count
+        energy_jobs = {(path, n): pool.submit(cached_energies, path, n, channels)
+                       for path in args.recordings for n in args.buckets}
+
+        jobs = []
+        for path, labels_path in zip(args.recordings, args.labels or [None] * len(args.recordings)):
+            t = load_times(path)
+            try:
+                labels = load_labels(path, labels_path, args.protocol, args.offset, t)
+            except ValueError as e:
+                parser.error(str(e))
+            if not np.any(labels != UNLABELLED):
+                print(f"Warning: {path} ({t[0]:.1f} - {t[-1]:.1f} s) has no labelled samples, check --offset")
+            duration = len(t) * np.median(np.diff(t[:1000])) if len(t) > 1 else 0
+            size = max(len(configs) // (4 * (args.workers or os.cpu_count() or 1)), 1)
+            for n in args.buckets:
+                try:
+                    energies_path = energy_jobs[path, n].result()
+                except ValueError as e:
+                    parser.error(str(e))
+                labels_n, bucket_seconds = bucket_labels(labels, n), duration / n
+                for chunk in chunks(configs, size):
+                    future = pool.submit(evaluate_configs, energies_path, labels_n, bucket_seconds, chunk)
+                    jobs.append((path, n, bucket_seconds, future))
+
+        for path, n, bucket_seconds, future in jobs:
+            for result in future.result():
+                results.append({"recording": path, "n_buckets": n, "bucket_ms": bucket_seconds * 1e3, **result})
+    print(f"Scored {len(results)} configurations in {time.perf_counter() - start:.1f} s")
+
+    for path in args.recordings:
+        ranked = sorted((r for r in results if r["recording"] == path), key=lambda r: r["balanced_accuracy"], reverse=True)
+        for result in ranked[:args.top]:
+            print(format_result(result))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from command_client import CommandClient
+
+
+@pytest.fixture
+def connection():
+    """(client, server end of the socket)"""
+    ours, theirs = socket.socketpair()
+    client = CommandClient(ours)
+    theirs.settimeout(1)
+    yield client, theirs
+    client.close()
+    ours.close()
+    theirs.close()
+
+
+def receive(sock, text):
+    data = b""
+    while len(data) < len(text):
+        data += sock.recv(1024)
+    return data.decode()
+
+
+def test_batch_keeps_other_threads_commands_out(connection):
+    client, server = connection
+    with client.batch():
+        client.set("runmode", "stop")
+        other = threading.Thread(target=client.get, args=("runmode",))
+        other.start()
+        other.join()
+        # Written while the batch is still open
+        assert receive(server, "get runmode;") == "get runmode;"
+        client.get("sampleratehertz")
+    assert receive(server, "set runmode stop;get sampleratehertz;") == "set runmode stop;get sampleratehertz;"
+
+
+def test_coalesced_replies(connection):
+    client, server = connection
+    rate, mode = client.get("sampleratehertz"), client.get("runmode")
+    server.sendall(b"Return: SampleRateHertz 20000Return: RunMode Stop")
+    assert rate.result(1) == "20000"
+    assert mode.result(1) == "Stop"
+
+
+def test_reply_split_across_reads(connection):
+    client, server = connection
+    rate = client.get("sampleratehertz")
+    server.sendall(b"Return: SampleRa")
+    # Lets the reader see the first part on its own
+    time.sleep(0.01)
+    server.sendall(b"teHertz 20000")
+    assert rate.result(1) == "20000"
+
+
+def test_reply_split_inside_next_prefix(connection):
+    client, server = connection
+    rate, mode = client.get("sampleratehertz"), client.get("runmode")
+    server.sendall(b"Return: SampleRateHertz 20000Ret")
+    time.sleep(0.01)
+    server.sendall(b"urn: RunMode Run")
+    assert rate.result(1) == "20000"
+    assert mode.result(1) == "Run"
+
+
+@pytest.mark.parametrize("value", ["R", "Re", "E", "Err", "Stop"])
+def test_value_like_a_prefix_is_not_held_back(connection, value):
+    client, server = connection
+    future = client.get("customparameter")
+    server.sendall(f"Return: CustomParameter {value}".encode())
+    assert future.result(1) == value
+
+
+def test_error_fails_its_command_and_confirms_earlier_sets(connection):
+    client, server = connection
+    notch = client.set("notchfilterfreqhertz", 60)
+    bad = client.set("bogus", 1)
+    mode = client.get("runmode")
+    server.sendall(b"Error: Unrecognized parameter bogusReturn: RunMode Stop")
+    assert notch.result(1) is None
+    with pytest.raises(Exception, match="bogus"):
+        bad.result(1)
+    assert mode.result(1) == "Stop"
+
+
+def test_set_waits_for_a_later_reply(connection):
+    client, server = connection
+    run = client.set("runmode", "run")
+    assert not run.done()
+    done = client.sync()
+    server.sendall(b"Return: RunMode Run")
+    assert done.result(1) == "Run"
+    assert run.result(1) is None
+
+
+def test_reply_split_before_its_value(connection):
+    client, server = connection
+    rate = client.get("sampleratehertz")
+    server.sendall(b"Return: SampleRateHertz")
+    time.sleep(0.01)
+    server.sendall(b" 20000")
+    assert rate.result(1) == "20000"
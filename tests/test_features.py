@@ -0,0 +1,22 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from features import FEATURES, FeatureExtractor, window_features
+
+
+@pytest.mark.parametrize("window, hop", [(50, 50), (50, 20), (20, 50), (7, 31)])
+@pytest.mark.parametrize("chunk", [1, 13, 64, 1000])
+def test_chunked_matches_one_shot(window, hop, chunk):
+    samples = np.random.default_rng(0).normal(size=(2, 3000)).astype(np.float32)
+    expected = window_features(samples, window, hop)
+
+    extractor = FeatureExtractor(2, window, hop)
+    blocks = [extractor.process(samples[:, start:start + chunk]) for start in range(0, samples.shape[1], chunk)]
+    for name in FEATURES:
+        chunked = np.concatenate([block[name] for block in blocks], axis=1)
+        np.testing.assert_allclose(chunked, expected[name], rtol=1e-6, atol=1e-6)
@@ -0,0 +1,58 @@
+import os
+import socket
+import sys
+
+import pytest
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from command_client import CommandClient
+from engine import configure_server, connect, stop_server
+from replay_server import ReplayServer, ReplaySource, arm_channels
+
+
+RECORDING = os.path.join(ROOT, "data", "raw", "botharms_230301_155959", "botharms_230301_160059.rhd")
+# Only A-021
+ONE_CHANNEL = os.path.join(ROOT, "data", "raw", "leftarm_230301_153723", "leftarm_230301_153823.rhd")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_configure_server_gets_no_errors(capsys):
+    source = ReplaySource(RECORDING)
+    server = ReplayServer(source, command_port=free_port(), waveform_port=free_port())
+    server.start()
+    scommand, swaveform = connect(server.host, server.command_port, server.waveform_port)
+    client = CommandClient(scommand)
+    try:
+        timestep = configure_server(client)
+        stop_server(client)
+    finally:
+        scommand.close()
+        swaveform.close()
+        server.stop()
+
+    assert timestep == 1 / source.sample_rate
+    assert client.errors == []
+    assert "Error" not in capsys.readouterr().out
+
+
+def test_arm_channels():
+    names = ReplaySource(RECORDING).channel_names
+    assert arm_channels(RECORDING, names) == [0, 1]
+    assert arm_channels(RECORDING, names, ("A-021", "A-015")) == [1, 0]
+    with pytest.raises(ValueError, match="a-099"):
+        arm_channels(RECORDING, names, ("A-015", "A-099"))
+    with pytest.raises(ValueError, match="1 channel"):
+        arm_channels(ONE_CHANNEL, ReplaySource(ONE_CHANNEL).channel_names)
+
+
+def test_unknown_channel_is_rejected():
+    server = ReplayServer(ReplaySource(ONE_CHANNEL))
+    assert server.handle_command("set a-021.tcpdataoutputenabled true") is None
+    assert server.handle_command("set a-015.tcpdataoutputenabled true").startswith("Error:")
+    assert server.enabled_channels == {"a-021"}
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ringbuffer import SampleRingBuffer
+
+
+def block(start, n):
+    return np.arange(start, start + n, dtype=np.int32), np.arange(start, start + n, dtype=np.float32)[None]
+
+
+def test_read_in_order():
+    ring = SampleRingBuffer(1, 8)
+    reader = ring.reader()
+    for start in range(0, 20, 3):
+        ring.write(*block(start, 3))
+        timestamps, samples = reader.read()
+        np.testing.assert_array_equal(timestamps, np.arange(start, start + 3))
+        np.testing.assert_array_equal(samples[0], timestamps)
+    assert reader.dropped == 0
+
+
+def test_lapped_reader_counts_drops():
+    ring = SampleRingBuffer(1, 8)
+    reader = ring.reader()
+    ring.write(*block(0, 12))
+    timestamps, _ = reader.read()
+    np.testing.assert_array_equal(timestamps, np.arange(4, 12))
+    assert reader.dropped == 4
+
+
+def test_write_in_progress_counts_as_overwritten():
+    ring = SampleRingBuffer(1, 8)
+    reader = ring.reader()
+    ring.write(*block(0, 6))
+
+    # A write of 4 samples has published its end and filled the first 2 lapped slots,
+    # but hasn't advanced written yet
+    ring.writing = ring.written + 4
+    for offset in (6, 7, 0, 1):
+        ring.timestamps[[offset, offset + ring.capacity]] = -1
+    timestamps, _ = reader.read()
+    np.testing.assert_array_equal(timestamps, [2, 3, 4, 5])
+    assert reader.dropped == 2
+    assert reader.cursor == 6
@@ -0,0 +1,179 @@
+import numpy as np
+
+
+MAGIC_NUMBER = 0x2ef07a08
+MAGIC_BYTES = MAGIC_NUMBER.to_bytes(4, "little")
+
+FRAMES_PER_BLOCK = 128
+ADC_OFFSET = 32768
+MICROVOLTS_PER_BIT = 0.195
+
+
+def block_dtype(n_channels=2):
+    # One waveform block: magic word followed by 128 frames of <i4 timestamp + n_channels <u2 samples
+    frame = np.dtype([("timestamp", "<i4"), ("samples", "<u2", (n_channels,))])
+    return np.dtype([("magic", "<u4"), ("frames", frame, (FRAMES_PER_BLOCK,))])
+
+
+def block_size(n_channels=2):
+    return block_dtype(n_channels).itemsize
+
+
+def to_microvolts(raw, out=None):
+    if out is None:
+        out = np.empty(np.shape(raw), dtype=np.float32)
+    np.subtract(raw, ADC_OFFSET, out=out, dtype=np.float32)
+    out *= MICROVOLTS_PER_BIT
+    return out
+
+
+def find_block_offsets(raw_data, n_channels=2):
+    """Byte offsets of every complete, magic-word aligned block in raw_data."""
+    size = block_size(n_channels)
+    start = raw_data.find(MAGIC_BYTES)
+    if start == -1:
+        return np.empty(0, dtype=np.intp)
+
+    buf = np.frombuffer(raw_data, dtype=np.uint8)
+    n_blocks = (len(buf) - start) // size
+    offsets = start + np.arange(n_blocks) * size
+    if _is_magic(buf, offsets).all():
+        return offsets
+
+    # Stream is misaligned somewhere: scan for every magic word in one pass, then chain
+    # candidates so that blocks never overlap.
+    candidates = np.flatnonzero(buf[:len(buf) - 3] == MAGIC_BYTES[0])
+    candidates = candidates[_is_magic(buf, candidates)]
+    candidates = candidates[candidates + size <= len(buf)]
+    offsets = []
+    next_free = 0
+    for offset in candidates:
+        if offset >= next_free:
+            offsets.append(offset)
+            next_free = offset + size
+    return np.array(offsets, dtype=np.intp)
+
+
+def _is_magic(buf, offsets):
+    ok = np.ones(len(offsets), dtype=bool)
+    for i, byte in enumerate(MAGIC_BYTES):
+        ok &= buf[offsets + i] == byte
+    return ok
+
+
+def decode_blocks(raw_data, n_channels=2):
+    """Decode magic-word framed waveform blocks.
+
+    Returns (timestamps, samples): an int32 array of shape (n,) and a float32 array of
+    microvolts with shape (n_channels, n), where n is 128 times the number of blocks found.
+    """
+    dtype = block_dtype(n_channels)
+    offsets = find_block_offsets(raw_data, n_channels)
+    if len(offsets) == 0:
+        return np.empty(0, dtype=np.int32), np.empty((n_channels, 0), dtype=np.float32)
+
+    if len(offsets) == 1 or (np.diff(offsets) == dtype.itemsize).all():
+        blocks = np.frombuffer(raw_data, dtype=dtype, count=len(offsets), offset=int(offsets[0]))
+    else:
+        blocks = np.concatenate([
+            np.frombuffer(raw_data, dtype=dtype, count=1, offset=int(offset)) for offset in offsets
+        ])
+    return decode_frames(blocks["frames"].reshape(-1))
+
+
+def decode_frames(frames):
+    timestamps = np.ascontiguousarray(frames["timestamp"])
+    samples = to_microvolts(frames["samples"].T)
+    return timestamps, samples
+
+
+class WaveformFramer:
+    """Reassembles waveform blocks that arrive split across recv() calls.
+
+    Bytes are read straight into a preallocated buffer with recv_into. Only complete,
+    magic-word aligned blocks are decoded; the trailing partial block is kept for the
+    next read.
+    """
+
+    def __init__(self, n_channels=2, capacity_blocks=64):
+        self.n_channels = n_channels
+        self.dtype = block_dtype(n_channels)
+        self.block_size = self.dtype.itemsize
+        self._buffer = bytearray(self.block_size * max(capacity_blocks, 2))
+        self._view = memoryview(self._buffer)
+        self._end = 0
+
+        self.bytes_received = 0
+        self.bytes_dropped = 0
+        self.resyncs = 0
+        self.blocks_decoded = 0
+
+    @property
+    def buffered(self):
+        return self._end
+
+    def recv_into(self, sock):
+        n = sock.recv_into(self._view[self._end:])
+        self._end += n
+        self.bytes_received += n
+        return n
+
+    def feed(self, data):
+        """Copy bytes from a non-socket source into the buffer, decoding as it fills up."""
+        data = memoryview(data)
+        decoded = []
+        while len(data):
+            n = min(len(data), len(self._buffer) - self._end)
+            self._view[self._end:self._end + n] = data[:n]
+            self._end += n
+            self.bytes_received += n
+            data = data[n:]
+            if len(data):
+                decoded.append(self.read())
+        decoded.append(self.read())
+        return _concatenate(decoded, self.n_channels)
+
+    def read(self):
+        """Decode every complete block in the buffer and keep the remainder.
+
+        Returns (timestamps, samples) in the same layout as decode_blocks.
+        """
+        decoded = []
+        pos = 0
+        end = self._end
+        while end - pos >= self.block_size:
+            if self._buffer[pos:pos + 4] != MAGIC_BYTES:
+                pos = self._resync(pos, end)
+                continue
+            n = (end - pos) // self.block_size
+            blocks = np.frombuffer(self._buffer, dtype=self.dtype, count=n, offset=pos)
+            bad = np.flatnonzero(blocks["magic"] != MAGIC_NUMBER)
+            good = n if len(bad) == 0 else int(bad[0])
+            decoded.append(decode_frames(blocks[:good]["frames"].reshape(-1)))
+            self.blocks_decoded += good
+            pos += good * self.block_size
+
+        # Carry the partial block over to the start of the buffer
+        remainder = end - pos
+        if pos:
+            self._buffer[:remainder] = self._buffer[pos:end]
+        self._end = remainder
+        return _concatenate(decoded, self.n_channels)
+
+    def _resync(self, pos, end):
+        self.resyncs += 1
+        found = self._buffer.find(MAGIC_BYTES, pos + 1, end)
+        if found == -1:
+            # Keep the last 3 bytes, they may be the start of a magic word
+            found = max(pos, end - 3)
+        self.bytes_dropped += found - pos
+        return found
+
+
+def _concatenate(decoded, n_channels):
+    if not decoded:
+        return np.empty(0, dtype=np.int32), np.empty((n_channels, 0), dtype=np.float32)
+    if len(decoded) == 1:
+        return decoded[0]
+    timestamps, samples = zip(*decoded)
+    return np.concatenate(timestamps), np.concatenate(samples, axis=1)